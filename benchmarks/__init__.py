@@ -0,0 +1,8 @@
+"""
+Benchmarks of the dei0 server, results are JSON files tagged with the git commit so runs can be compared.
+
+ python -m benchmarks.data --recipes 2000 --drop              seed the DEI0_MONGODB_URI database
+ python -m benchmarks.load --url http://localhost:8000 -c 32  drive every router, p50/p95/p99 per route
+ python -m benchmarks.micro                                   model parsing/serialization
+ python -m benchmarks.results compare base.json new.json      compare two runs
+"""
@@ -0,0 +1,180 @@
+"""
+Synthetic, reproducible data set: the same seed and volumes always give the same documents.
+
+Documents are written through server.bulk, so derived fields (nutrition, name_key,
+allergen_mask, revisions) are computed as in production. Every user has the
+password BENCH_PASSWORD, the load driver logs in with them.
+"""
+import argparse
+import asyncio
+import random
+import sys
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterable, List
+
+from bson import ObjectId
+from fastapi_users.password import PasswordHelper
+
+from server import db
+from server.bulk import bulk_import
+from server.models import (DOCUMENT_MODELS, DayOfWeek, Gender, Ingredient, IngredientType, KindOfMeal, MealPlan,
+                           MeasureUnit, MUnitOptions, Recipe, User, UserProfile, UserRole, USAStates)
+from server.settings import get_settings
+
+BENCH_PASSWORD = "bench-password"
+BENCH_EMAIL_DOMAIN = "bench.dei0"
+
+SYLLABLES = ["ja", "mon", "to", "ma", "te", "pa", "ta", "ce", "bo", "lla", "que", "so", "ar", "roz", "po", "llo",
+             "le", "che", "ñu", "ño", "ga", "lle", "tas", "hue", "vo", "cá", "fé", "nuez", "sal", "mí"]
+
+
+@dataclass
+class Volumes:
+    ingredients: int = 500
+    recipes: int = 2000
+    mealplans: int = 500
+    users: int = 200
+    ingredients_per_recipe: int = 8
+    foods_per_mealplan: int = 21
+
+
+def word(rng: random.Random, syllables: int) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(syllables))
+
+
+def unique_names(rng: random.Random, count: int, prefix: str) -> List[str]:
+    # readable random words, numbered so names stay unique
+    return [f"{word(rng, rng.randint(2, 4)).capitalize()} {prefix}{number}" for number in range(count)]
+
+
+def make_ingredients(rng: random.Random, count: int) -> List[Dict[str, Any]]:
+    types = list(IngredientType)
+    return [{
+        "_id": ObjectId(rng.randbytes(12)),
+        "name": name,
+        "aliment_types": [aliment_type.value for aliment_type in rng.sample(types, rng.randint(1, 3))],
+        "nutrients": {field: round(rng.uniform(0, 100), 1)
+                      for field in ("kcal", "protein", "fat", "carbs", "sodium", "sugar")},
+        "unit_weight": round(rng.uniform(5, 300), 1),
+    } for name in unique_names(rng, count, "i")]
+
+
+def make_recipes(rng: random.Random, count: int, ingredients: List[Dict[str, Any]],
+                 per_recipe: int) -> List[Dict[str, Any]]:
+    units = list(MeasureUnit)
+    return [{
+        "name": name,
+        "preparation": " ".join(word(rng, rng.randint(1, 3)) for _ in range(rng.randint(20, 80))),
+        "ingredients": [{
+            "ingredient": ingredient,
+            "quantity": round(rng.uniform(1, 500), 1),
+            "measure_unit": rng.choice(units).value,
+        } for ingredient in rng.sample(ingredients, min(per_recipe, len(ingredients)))],
+    } for name in unique_names(rng, count, "r")]
+
+
+def make_mealplans(rng: random.Random, count: int, recipe_names: List[str], per_plan: int) -> List[Dict[str, Any]]:
+    return [{
+        "name": name,
+        "obser": word(rng, 5),
+        "foods": [{
+            "portion": rng.choice([0.5, 1, 1.5, 2]),
+            "measure_unit": MeasureUnit.UNIT.value,
+            "recipe_name": rng.choice(recipe_names),
+            "kom": rng.choice(list(KindOfMeal)).value,
+            "dow": rng.choice(list(DayOfWeek)).value,
+        } for _ in range(per_plan)],
+    } for name in unique_names(rng, count, "p")]
+
+
+def make_users(rng: random.Random, count: int, hashed_password: str) -> List[Dict[str, Any]]:
+    return [{
+        "_id": ObjectId(rng.randbytes(12)),
+        "email": f"user{number}@{BENCH_EMAIL_DOMAIN}",
+        "hashed_password": hashed_password,
+        "is_active": True,
+        "is_verified": True,
+        "name": word(rng, 2).capitalize(),
+        "surname": word(rng, 3).capitalize(),
+        "alias": f"user{number}",
+        "role": rng.choice(list(UserRole)).value,
+    } for number in range(count)]
+
+
+def make_userprofiles(rng: random.Random, users: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [{
+        "user_id": str(user["_id"]),
+        "user_alias": user["alias"],
+        "phone_number": "+1415555" + f"{rng.randint(0, 9999):04d}",
+        "gender": rng.choice(list(Gender)).value,
+        "zipcode": rng.randint(10000, 99999),
+        "city": word(rng, 3).capitalize(),
+        "state": rng.choice(list(USAStates)).value,
+        "nationality": "us",
+        "metric_unit": {"muselected": rng.choice(list(MUnitOptions)).value},
+        "height": rng.randint(150, 200),
+        "starting_weight": rng.randint(50, 120),
+        "health_profile": {
+            "celiac": rng.random() < 0.1, "diabetis": rng.random() < 0.1, "gluten_aller": rng.random() < 0.05,
+            "lactose_aller": rng.random() < 0.1, "caffeine_aller": False, "nuts_aller": rng.random() < 0.05,
+            "other_aller": "", "chronical_disease": "", "medication": "",
+        },
+        "foods_profile": {
+            "celiac": False, "meat_dislike": rng.random() < 0.1, "fish_dislike": rng.random() < 0.2,
+            "eggs_dislike": False, "cheese_dislike": rng.random() < 0.1, "other_dislike": "",
+        },
+    } for user in users]
+
+
+def generate(volumes: Volumes, seed: int) -> Dict[str, List[Dict[str, Any]]]:
+    rng = random.Random(seed)
+    hashed_password = PasswordHelper().hash(BENCH_PASSWORD)  # bcrypt once, shared by every user
+    ingredients = make_ingredients(rng, volumes.ingredients)
+    recipes = make_recipes(rng, volumes.recipes, ingredients, volumes.ingredients_per_recipe)
+    mealplans = make_mealplans(rng, volumes.mealplans, [recipe["name"] for recipe in recipes],
+                               volumes.foods_per_mealplan)
+    users = make_users(rng, volumes.users, hashed_password)
+    return {
+        "ingredients": ingredients,
+        "recipes": recipes,
+        "mealplans": mealplans,
+        "users": users,
+        "userprofiles": make_userprofiles(rng, users),
+    }
+
+
+async def iterate(items: Iterable[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    for item in items:
+        yield item
+
+
+async def seed(volumes: Volumes, seed_value: int, drop: bool) -> int:
+    await db.connect(get_settings(), DOCUMENT_MODELS)
+    if drop:
+        for model in DOCUMENT_MODELS:
+            await model.get_motor_collection().delete_many({})
+    data = generate(volumes, seed_value)
+    failed = 0
+    for model, key in ((Ingredient, "ingredients"), (Recipe, "recipes"), (MealPlan, "mealplans"),
+                       (User, "users"), (UserProfile, "userprofiles")):
+        report = await bulk_import(model, iterate(data[key]))
+        failed += report.failed
+        print(f"{model.__name__}: {report.created} created, {report.failed} failed")
+    db.close()
+    return 1 if failed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.data", description="seed the benchmark data set")
+    defaults = Volumes()
+    for name in ("ingredients", "recipes", "mealplans", "users", "ingredients_per_recipe", "foods_per_mealplan"):
+        parser.add_argument("--" + name.replace("_", "-"), type=int, default=getattr(defaults, name))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--drop", action="store_true", help="empty the collections first")
+    args = parser.parse_args(argv)
+    volumes = Volumes(**{name: getattr(args, name) for name in Volumes.__dataclass_fields__})
+    return asyncio.run(seed(volumes, args.seed, args.drop))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
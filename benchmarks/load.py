@@ -0,0 +1,227 @@
+"""
+Load driver: concurrent clients with a weighted mix of requests over every router.
+
+Each client logs in through /auth/jwt/login as one of the seeded users and then
+sends requests until the duration is over; latencies are grouped by route
+template. --in-process runs the app in this process through httpx's ASGI
+transport (no uvicorn, no network), against DEI0_MONGODB_URI.
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Tuple
+
+import httpx
+
+from .data import BENCH_EMAIL_DOMAIN, BENCH_PASSWORD
+from .results import summarize, write_results
+
+LOGIN = "/auth/jwt/login"
+# an SSE stream never ends, the request is timed until its first frame (the subscription is registered)
+CHANGES = "GET /meals/changes"
+
+
+@dataclass
+class Catalog:
+    """_id and names read from the seeded database, requests pick their targets from it."""
+    ingredients: List[Dict[str, Any]] = field(default_factory=list)
+    recipes: List[Dict[str, Any]] = field(default_factory=list)
+    mealplans: List[Dict[str, Any]] = field(default_factory=list)
+    users: List[Dict[str, Any]] = field(default_factory=list)
+    userprofiles: List[Dict[str, Any]] = field(default_factory=list)
+
+
+Request = Tuple[str, str, Dict[str, Any]]  # method, url, httpx keyword arguments
+RequestBuilder = Callable[[Catalog, random.Random], Request]
+
+
+def pick(rng: random.Random, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return rng.choice(documents)
+
+
+def prefix(rng: random.Random, documents: List[Dict[str, Any]]) -> str:
+    return pick(rng, documents)["name"][:3]
+
+
+# route template -> (weight, write, request builder)
+ROUTES: Dict[str, Tuple[int, bool, RequestBuilder]] = {
+    "GET /meals/ingredients/": (4, False, lambda c, r: ("GET", "/meals/ingredients/", {"params": {"limit": 100}})),
+    "GET /meals/ingredients/{id}": (6, False, lambda c, r: ("GET", f"/meals/ingredients/{pick(r, c.ingredients)['_id']}", {})),
+    "GET /meals/ingredients/search": (8, False, lambda c, r: ("GET", "/meals/ingredients/search",
+                                                              {"params": {"q": prefix(r, c.ingredients)}})),
+    "GET /meals/recipes/": (4, False, lambda c, r: ("GET", "/meals/recipes/", {"params": {"limit": 50}})),
+    "GET /meals/recipes/?view=summary": (4, False, lambda c, r: ("GET", "/meals/recipes/",
+                                                                 {"params": {"limit": 200, "view": "summary"}})),
+    "GET /meals/recipes/{id}": (10, False, lambda c, r: ("GET", f"/meals/recipes/{pick(r, c.recipes)['_id']}", {})),
+    "GET /meals/recipes/search": (8, False, lambda c, r: ("GET", "/meals/recipes/search",
+                                                          {"params": {"q": prefix(r, c.recipes)}})),
+    "GET /meals/recipes/compatible/{id}": (3, False, lambda c, r: (
+        "GET", f"/meals/recipes/compatible/{pick(r, c.userprofiles)['_id']}", {"params": {"limit": 50, "view": "summary"}})),
+    "GET /meals/mealplans/": (2, False, lambda c, r: ("GET", "/meals/mealplans/", {"params": {"limit": 50}})),
+    "GET /meals/mealplans/{id}": (8, False, lambda c, r: ("GET", f"/meals/mealplans/{pick(r, c.mealplans)['_id']}", {})),
+    "GET /meals/mealplans/{id}/foods": (8, False, lambda c, r: (
+        "GET", f"/meals/mealplans/{pick(r, c.mealplans)['_id']}/foods", {"params": {"dow": "mo", "kom": "lu"}})),
+    "GET /meals/mealplans/{id}/nutrition": (4, False, lambda c, r: (
+        "GET", f"/meals/mealplans/{pick(r, c.mealplans)['_id']}/nutrition", {})),
+    "GET /meals/mealplans/{id}/shopping-list": (3, False, lambda c, r: (
+        "GET", f"/meals/mealplans/{pick(r, c.mealplans)['_id']}/shopping-list", {})),
+    "GET /meals/users/": (1, False, lambda c, r: ("GET", "/meals/users/", {"params": {"limit": 100}})),
+    "GET /meals/users/{id}": (4, False, lambda c, r: ("GET", f"/meals/users/{pick(r, c.users)['_id']}", {})),
+    "GET /meals/userprofiles/{id}": (4, False, lambda c, r: (
+        "GET", f"/meals/userprofiles/{pick(r, c.userprofiles)['_id']}", {})),
+    "GET /meals/userprofiles/by-user/{user_id}": (6, False, lambda c, r: (
+        "GET", f"/meals/userprofiles/by-user/{pick(r, c.userprofiles)['user_id']}", {})),
+    "PUT /meals/recipes/{id}/update": (2, True, lambda c, r: (
+        "PUT", f"/meals/recipes/{pick(r, c.recipes)['_id']}/update", {"json": {"preparation": f"bench {r.random()}"}})),
+    "PUT /meals/mealplans/{id}/update": (2, True, lambda c, r: (
+        "PUT", f"/meals/mealplans/{pick(r, c.mealplans)['_id']}/update", {"json": {"obser": f"bench {r.random()}"}})),
+    "GET /meals/analytics/userprofiles": (1, False, lambda c, r: ("GET", "/meals/analytics/userprofiles", {})),
+    "GET /meals/analytics/userprofiles?group_by=state": (1, False, lambda c, r: (
+        "GET", "/meals/analytics/userprofiles", {"params": {"group_by": ["state", "gender"]}})),
+    CHANGES: (1, False, lambda c, r: ("GET", "/meals/changes", {"params": {"collections": "mealplans"}})),
+    "POST " + LOGIN: (1, False, lambda c, r: ("POST", LOGIN, {"data": credentials(pick(r, c.users)["alias"])})),
+}
+
+
+def credentials(alias: str) -> Dict[str, str]:
+    return {"username": f"{alias}@{BENCH_EMAIL_DOMAIN}", "password": BENCH_PASSWORD}
+
+
+async def login(client: httpx.AsyncClient, alias: str) -> Dict[str, str]:
+    response = await client.post(LOGIN, data=credentials(alias))
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def load_catalog(client: httpx.AsyncClient, headers: Dict[str, str]) -> Catalog:
+    catalog = Catalog()
+    for name in ("ingredients", "recipes", "mealplans", "users", "userprofiles"):
+        response = await client.get(f"/meals/{name}/", params={"view": "summary", "limit": 1000}, headers=headers)
+        response.raise_for_status()
+        setattr(catalog, name, response.json())
+    catalog.users = [user for user in catalog.users if user["alias"].startswith("user")]
+    if not all((catalog.ingredients, catalog.recipes, catalog.mealplans, catalog.users, catalog.userprofiles)):
+        raise SystemExit("the database is not seeded, run python -m benchmarks.data first")
+    return catalog
+
+
+async def change_feed_enabled(client: httpx.AsyncClient, headers: Dict[str, str]) -> bool:
+    # --in-process never starts the feed, the ASGI transport would wait for the end of the stream anyway
+    async with client.stream("GET", "/meals/changes", headers=headers) as response:
+        return response.status_code != 503
+
+
+@dataclass
+class Recorder:
+    samples: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    errors: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    recording: bool = False
+
+    def add(self, route: str, elapsed_ms: float, failed: bool):
+        if not self.recording:
+            return
+        self.samples[route].append(elapsed_ms)
+        if failed:
+            self.errors[route] += 1
+
+
+async def run_client(client: httpx.AsyncClient, catalog: Catalog, routes: List[str], weights: List[int],
+                     headers: Dict[str, str], rng: random.Random, recorder: Recorder, deadline: float):
+    while time.perf_counter() < deadline:
+        route = rng.choices(routes, weights)[0]
+        method, url, options = ROUTES[route][2](catalog, rng)
+        started = time.perf_counter()
+        try:
+            if route == CHANGES:
+                async with client.stream(method, url, headers=headers, **options) as response:
+                    await response.aiter_raw().__anext__()
+            else:
+                response = await client.request(method, url, headers=headers, **options)
+            failed = response.status_code >= 400
+        except (httpx.HTTPError, StopAsyncIteration):
+            failed = True
+        recorder.add(route, (time.perf_counter() - started) * 1000, failed)
+
+
+async def drive(client: httpx.AsyncClient, concurrency: int, duration: float, warmup: float, read_only: bool,
+                seed: int) -> Tuple[Dict[str, Dict[str, Any]], float]:
+    catalog = await load_catalog(client, await login(client, "user0"))
+    sessions = [await login(client, catalog.users[number % len(catalog.users)]["alias"]) for number in range(concurrency)]
+    routes = [route for route, (_, write, _) in ROUTES.items() if not (read_only and write)]
+    if not await change_feed_enabled(client, sessions[0]):
+        print("the change feed is off (DEI0_CHANGE_FEED), leaving out " + CHANGES, file=sys.stderr)
+        routes.remove(CHANGES)
+    weights = [ROUTES[route][0] for route in routes]
+
+    recorder = Recorder()
+    deadline = time.perf_counter() + warmup + duration
+    clients = [run_client(client, catalog, routes, weights, sessions[number], random.Random(seed + number),
+                          recorder, deadline) for number in range(concurrency)]
+
+    async def start_recording():
+        await asyncio.sleep(warmup)
+        recorder.recording = True
+    started = time.perf_counter()
+    await asyncio.gather(start_recording(), *clients)
+    measured = time.perf_counter() - started - warmup
+
+    entries = {route: summarize(recorder.samples[route], recorder.errors[route], measured)
+               for route in routes if recorder.samples[route]}
+    every = [sample for route in routes for sample in recorder.samples[route]]
+    entries["ALL"] = summarize(every, sum(recorder.errors.values()), measured)
+    return entries, measured
+
+
+async def run(args) -> int:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.in_process:
+        from server import db
+        from server.app import app
+        from server.models import DOCUMENT_MODELS
+        from server.queryplans import inspector, print_report
+        from server.settings import get_settings
+
+        # the ASGI transport does not send lifespan events, the pool is opened here
+        settings = get_settings()
+        motor_client = await db.connect(settings, DOCUMENT_MODELS)
+        if settings.query_plans:
+            inspector.start(motor_client, settings.query_plan_max_ratio, settings.query_plan_min_docs_examined)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://dei0", timeout=args.timeout)
+    else:
+        client = httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout)
+    async with client:
+        entries, measured = await drive(client, args.concurrency, args.duration, args.warmup, args.read_only, args.seed)
+    if args.in_process:
+        if settings.query_plans:
+            await inspector.explained()
+            print_report(inspector.report())
+            inspector.stop()
+        db.close()
+
+    config = {"target": "in-process" if args.in_process else args.url, "concurrency": args.concurrency,
+              "duration": args.duration, "warmup": args.warmup, "read_only": args.read_only, "seed": args.seed}
+    write_results(args.out, "load", config, entries)
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load", description="dei0 load driver")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--in-process", action="store_true", help="run the app in this process (ASGI transport)")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-d", "--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds sent before measuring")
+    parser.add_argument("--read-only", action="store_true", help="leave out the PUT routes")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--out", help="JSON result file")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Micro-benchmarks of model parsing and serialization, no HTTP and no queries.
+
+Every entry runs its operation in batches; the result of a batch is the mean
+time of one operation, p50/p95/p99 are taken over the batches. Beanie needs an
+initialized database to build documents, nothing is written to it:
+DEI0_MONGODB_URI, or mongomock-motor with --in-memory (not in requirements.txt).
+"""
+import argparse
+import asyncio
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+from beanie.odm.utils.dump import get_dict
+from pydantic import TypeAdapter
+
+from server.fastjson import dumps
+from server.models import DOCUMENT_MODELS, MealPlan, Recipe, UserProfile, body_mass_index
+
+from .data import Volumes, generate
+from .results import summarize, write_results
+
+
+async def init_models(in_memory: bool):
+    if in_memory:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            raise SystemExit("--in-memory needs mongomock-motor (pip install mongomock-motor)")
+        from beanie import init_beanie
+        await init_beanie(AsyncMongoMockClient()["bench"], document_models=DOCUMENT_MODELS)
+    else:
+        from server import db
+        from server.settings import get_settings
+        await db.connect(get_settings(), DOCUMENT_MODELS, sync_indexes=False)
+
+
+def measure(operation: Callable[[], Any], batches: int, batch_size: int) -> List[float]:
+    for _ in range(batch_size):  # warm up
+        operation()
+    samples = []
+    for _ in range(batches):
+        started = time.perf_counter()
+        for _ in range(batch_size):
+            operation()
+        samples.append((time.perf_counter() - started) * 1000 / batch_size)
+    return samples
+
+
+def stored_recipe(document: Dict[str, Any]) -> Dict[str, Any]:
+    # the recipe as Motor returns it, with the derived fields the write hooks add
+    recipe = Recipe.model_validate(document)
+    recipe.compute_nutrition()
+    recipe.compute_allergen_mask()
+    recipe.set_name_key()
+    return get_dict(recipe, to_db=True)
+
+
+def operations(seed: int, ingredients_per_recipe: int, page_size: int) -> Dict[str, Callable[[], Any]]:
+    volumes = Volumes(ingredients=200, recipes=page_size, mealplans=1, users=1,
+                      ingredients_per_recipe=ingredients_per_recipe)
+    data = generate(volumes, seed)
+    recipe_rows = [stored_recipe(recipe) for recipe in data["recipes"]]
+    recipe_row = recipe_rows[0]
+    recipe = Recipe.model_validate(recipe_row)
+    recipes = [Recipe.model_validate(row) for row in recipe_rows]
+    recipe_list = TypeAdapter(List[Recipe])
+    profile_row = data["userprofiles"][0]
+    profile = UserProfile.model_validate(profile_row)
+    mealplan_row = data["mealplans"][0]
+
+    return {
+        "Recipe.model_validate": lambda: Recipe.model_validate(recipe_row),
+        "Recipe.model_dump_json": lambda: recipe.model_dump_json(by_alias=True),
+        "Recipe.compute_nutrition": recipe.compute_nutrition,
+        f"List[Recipe] x{page_size} parse": lambda: [Recipe.model_validate(row) for row in recipe_rows],
+        # what FastAPI does with a response_model: dump the documents, then validate them again
+        f"List[Recipe] x{page_size} response_model": lambda: recipe_list.validate_python(
+            [document.model_dump(by_alias=True) for document in recipes]),
+        f"List[Recipe] x{page_size} dump_json": lambda: recipe_list.dump_json(recipes, by_alias=True),
+        f"List[Recipe] x{page_size} raw orjson": lambda: dumps(recipe_rows),
+        "UserProfile.model_validate": lambda: UserProfile.model_validate(profile_row),
+        "body_mass_index": lambda: body_mass_index(profile.metric_unit, profile.height, profile.starting_weight),
+        "UserProfile.model_dump_json": lambda: profile.model_dump_json(by_alias=True),
+        "MealPlan.model_validate": lambda: MealPlan.model_validate(mealplan_row),
+    }
+
+
+async def run(args) -> int:
+    await init_models(args.in_memory)
+    entries = {}
+    for name, operation in operations(args.seed, args.ingredients_per_recipe, args.page_size).items():
+        if args.filter and args.filter not in name:
+            continue
+        entries[name] = summarize(measure(operation, args.batches, args.batch_size))
+    config = {"batches": args.batches, "batch_size": args.batch_size, "seed": args.seed,
+              "ingredients_per_recipe": args.ingredients_per_recipe, "page_size": args.page_size}
+    write_results(args.out, "micro", config, entries)
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.micro", description="dei0 model micro-benchmarks")
+    parser.add_argument("--in-memory", action="store_true", help="initialize beanie on mongomock-motor instead of Mongo")
+    parser.add_argument("--batches", type=int, default=30)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=50, help="recipes in the list entries")
+    parser.add_argument("--ingredients-per-recipe", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-k", "--filter", help="only the entries containing this text")
+    parser.add_argument("-o", "--out", help="JSON result file")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
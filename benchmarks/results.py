@@ -0,0 +1,108 @@
+"""
+Result files shared by the load and micro benchmarks.
+
+ python -m benchmarks.results compare base.json new.json   per-entry change of p50/p95/p99 and throughput
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+
+def percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    # nearest rank on values already sorted
+    if not sorted_values:
+        return 0.0
+    rank = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(samples_ms: List[float], errors: int = 0, duration_s: Optional[float] = None) -> Dict[str, Any]:
+    values = sorted(samples_ms)
+    summary = {
+        "count": len(values),
+        "errors": errors,
+        "mean_ms": round(sum(values) / len(values), 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 0.50), 3),
+        "p95_ms": round(percentile(values, 0.95), 3),
+        "p99_ms": round(percentile(values, 0.99), 3),
+    }
+    if duration_s:
+        summary["throughput_rps"] = round(len(values) / duration_s, 1)
+    return summary
+
+
+def git_commit() -> Optional[str]:
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True)
+    return output.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+
+
+def write_results(path: Optional[str], kind: str, config: Dict[str, Any], entries: Dict[str, Dict[str, Any]]):
+    results = {
+        "kind": kind,
+        "commit": git_commit(),
+        "date": datetime.utcnow().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": config,
+        "entries": entries,
+    }
+    print_table(entries)
+    if path:
+        with open(path, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"results written to {path}")
+
+
+def print_table(entries: Dict[str, Dict[str, Any]]):
+    width = max([len(name) for name in entries] + [10])
+    print(f"{'entry':<{width}} {'count':>8} {'err':>5} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, entry in sorted(entries.items()):
+        print(f"{name:<{width}} {entry['count']:>8} {entry['errors']:>5} {entry.get('throughput_rps', ''):>9} "
+              f"{entry['p50_ms']:>9} {entry['p95_ms']:>9} {entry['p99_ms']:>9}")
+
+
+def change(base: float, new: float) -> str:
+    if not base:
+        return "n/a"
+    return f"{(new - base) / base * 100:+.1f}%"
+
+
+def compare(base_path: str, new_path: str) -> int:
+    with open(base_path) as base_file, open(new_path) as new_file:
+        base, new = json.load(base_file), json.load(new_file)
+    print(f"base {base['commit']} ({base['date']})  new {new['commit']} ({new['date']})")
+    if base["config"] != new["config"]:
+        print("warning: the runs used different configurations")
+    width = max([len(name) for name in new["entries"]] + [10])
+    print(f"{'entry':<{width}} {'p50':>9} {'p95':>9} {'p99':>9} {'rps':>9}")
+    for name, entry in sorted(new["entries"].items()):
+        previous = base["entries"].get(name)
+        if previous is None:
+            print(f"{name:<{width}} new")
+            continue
+        print(f"{name:<{width}} {change(previous['p50_ms'], entry['p50_ms']):>9} "
+              f"{change(previous['p95_ms'], entry['p95_ms']):>9} {change(previous['p99_ms'], entry['p99_ms']):>9} "
+              f"{change(previous.get('throughput_rps', 0), entry.get('throughput_rps', 0)):>9}")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.results", description="benchmark results")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    args = parser.parse_args(argv)
+    return compare(args.base, args.new)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
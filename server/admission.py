@@ -0,0 +1,181 @@
+"""
+Admission control and request deadlines.
+
+Every request belongs to an admission class (catalog reads, meal plan writes,
+everything else). A class runs at most `concurrency` requests at once and
+keeps at most `queue` waiting; a request that finds the queue full, or waits
+longer than DEI0_ADMISSION_QUEUE_TIMEOUT_MS, is answered 503 with
+Retry-After instead of piling up on the event loop and the Mongo pool.
+
+With DEI0_REQUEST_TIMEOUT_MS every request also gets a deadline, counted from
+its arrival (a client may ask for a shorter one with X-Request-Timeout-Ms).
+It is applied with pymongo.timeout, so every Mongo operation of the request
+is sent with the remaining time as maxTimeMS and abandoned work stops in the
+database too; a request out of time answers 504.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Deque, List, Optional, Sequence, Tuple
+
+import pymongo
+from pymongo.errors import PyMongoError, ServerSelectionTimeoutError
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .metrics import ADMISSION_QUEUE_WAIT, ADMISSION_REJECTIONS
+from .settings import Settings
+
+# long-lived streams and operations endpoints are never queued nor cut by the deadline
+EXEMPT_PATHS = ("/metrics", "/query-plans", "/meals/changes")
+READ_METHODS = ("GET", "HEAD")
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+TIMEOUT_HEADER = b"x-request-timeout-ms"
+DEADLINE_SCOPE_KEY = "dei0.deadline"  # monotonic time the request runs out, only set when it has a deadline
+
+
+class Limiter:
+    """At most concurrency holders, at most queue waiters in arrival order."""
+
+    def __init__(self, name: str, concurrency: int, queue: int, queue_timeout: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> Optional[str]:
+        """None once admitted, otherwise why the request is rejected."""
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            return None
+        if len(self.waiters) >= self.queue:
+            return "queue_full"
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._forget(waiter)
+            return "queue_timeout"
+        except asyncio.CancelledError:
+            # the slot may have been handed over just before the cancellation
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self._forget(waiter)
+            raise
+        return None
+
+    def release(self):
+        # the slot goes straight to the next waiter, active only drops when nobody waits
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def _forget(self, waiter: asyncio.Future):
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+
+AdmissionClass = Tuple[Limiter, Sequence[str], Sequence[str]]  # limiter, methods, path prefixes
+
+
+def admission_classes(settings: Settings) -> List[AdmissionClass]:
+    """Checked in order, the last one takes every other request."""
+    timeout = settings.admission_queue_timeout_ms / 1000
+    return [
+        (Limiter("catalog_reads", settings.catalog_read_concurrency, settings.catalog_read_queue, timeout),
+         READ_METHODS, ("/meals/ingredients", "/meals/recipes")),
+        (Limiter("mealplan_writes", settings.mealplan_write_concurrency, settings.mealplan_write_queue, timeout),
+         WRITE_METHODS, ("/meals/mealplans",)),
+        (Limiter("default", settings.default_concurrency, settings.default_queue, timeout), (), ("/",)),
+    ]
+
+
+def request_timeout(scope: Scope, default_ms: int) -> Optional[float]:
+    timeout_ms = default_ms or None
+    for name, value in scope["headers"]:
+        if name == TIMEOUT_HEADER:
+            try:
+                requested = int(value)
+            except ValueError:
+                break
+            if requested > 0:
+                timeout_ms = min(timeout_ms, requested) if timeout_ms else requested
+            break
+    return timeout_ms / 1000 if timeout_ms else None
+
+
+def overloaded(retry_after: int) -> Response:
+    return JSONResponse({"detail": "server overloaded, retry later"}, status_code=503,
+                        headers={"Retry-After": str(retry_after)})
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware: queue or shed the request by class, then run it under its deadline."""
+
+    def __init__(self, app: ASGIApp, classes: List[AdmissionClass], request_timeout_ms: int = 0,
+                 retry_after: int = 1):
+        self.app = app
+        self.classes = classes
+        self.request_timeout_ms = request_timeout_ms
+        self.retry_after = retry_after
+
+    def limiter_for(self, method: str, path: str) -> Optional[Limiter]:
+        for limiter, methods, prefixes in self.classes:
+            if (not methods or method in methods) and path.startswith(prefixes):
+                return limiter
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"].startswith(EXEMPT_PATHS):
+            await self.app(scope, receive, send)
+            return
+
+        arrived = time.monotonic()
+        timeout = request_timeout(scope, self.request_timeout_ms)
+        limiter = self.limiter_for(scope["method"], scope["path"])
+        if limiter is not None:
+            rejected = await limiter.acquire()
+            ADMISSION_QUEUE_WAIT.labels(limiter.name).observe(time.monotonic() - arrived)
+            if rejected:
+                ADMISSION_REJECTIONS.labels(limiter.name, rejected).inc()
+                await overloaded(self.retry_after)(scope, receive, send)
+                return
+        try:
+            if timeout is None:
+                await self.app(scope, receive, send)
+                return
+            remaining = timeout - (time.monotonic() - arrived)
+            if remaining <= 0:
+                await deadline_exceeded()(scope, receive, send)
+                return
+            scope[DEADLINE_SCOPE_KEY] = arrived + timeout
+            with pymongo.timeout(remaining):
+                await self.app(scope, receive, send)
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+
+def deadline_exceeded() -> Response:
+    return JSONResponse({"detail": "request deadline exceeded"}, status_code=504)
+
+
+async def mongo_error_handler(request: Request, error: PyMongoError) -> Response:
+    """504 for a Mongo operation out of time (maxTimeMS, pool wait or socket) under the request deadline."""
+    deadline = request.scope.get(DEADLINE_SCOPE_KEY)
+    if deadline is None or not error.timeout:
+        raise error
+    # no server to select before the deadline is an outage, not a slow request
+    if isinstance(error, ServerSelectionTimeoutError) and time.monotonic() < deadline:
+        raise error
+    return deadline_exceeded()
@@ -0,0 +1,98 @@
+"""
+Ingredient types as bits, so recipes can be filtered for a profile with one $bitsAllClear.
+
+ python -m server.allergens backfill   compute allergen_mask of the recipes written before it existed
+"""
+import argparse
+import asyncio
+import sys
+from typing import Any, Iterable, Optional
+
+from pymongo import UpdateOne
+
+# bit of every ingredient type in Recipe.allergen_mask, stored in mongo: never renumber, only append
+ALLERGEN_BITS = {
+    'gluten': 0,
+    'fat': 1,
+    'sodium': 2,
+    'sugar': 3,
+    'meat': 4,
+    'fish': 5,
+    'eggs': 6,
+    'cheese': 7,
+    'lactose': 8,
+    'caffeine': 9,
+    'nuts': 10,
+}
+
+# ingredient types a profile flag rules out (HealthProfile and FoodsProfile flags)
+PROFILE_AVOIDS = {
+    'celiac': ('gluten',),
+    'gluten_aller': ('gluten',),
+    'diabetis': ('sugar',),
+    'lactose_aller': ('lactose', 'cheese'),
+    'caffeine_aller': ('caffeine',),
+    'nuts_aller': ('nuts',),
+    'meat_dislike': ('meat',),
+    'fish_dislike': ('fish',),
+    'eggs_dislike': ('eggs',),
+    'cheese_dislike': ('cheese',),
+}
+
+
+def types_mask(types: Iterable[str]) -> int:
+    mask = 0
+    for aliment_type in types:
+        bit = ALLERGEN_BITS.get(aliment_type)
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+
+def avoided_mask(*profiles: Optional[Any]) -> int:
+    """Bits of the ingredient types the profiles rule out, compatible recipes have all of them clear."""
+    avoided = [
+        aliment_type
+        for profile in profiles if profile is not None
+        for flag, aliment_types in PROFILE_AVOIDS.items() if getattr(profile, flag, False)
+        for aliment_type in aliment_types
+    ]
+    return types_mask(avoided)
+
+
+async def backfill_masks(chunk_size: int = 500) -> int:
+    from .models import Recipe, recipe_allergen_mask
+
+    collection = Recipe.get_motor_collection()
+    operations, updated = [], 0
+    async for recipe in Recipe.find({"allergen_mask": {"$exists": False}}):
+        operations.append(UpdateOne({"_id": recipe.id}, {"$set": {"allergen_mask": recipe_allergen_mask(recipe.ingredients)}}))
+        if len(operations) == chunk_size:
+            updated += (await collection.bulk_write(operations, ordered=False)).modified_count
+            operations = []
+    if operations:
+        updated += (await collection.bulk_write(operations, ordered=False)).modified_count
+    return updated
+
+
+async def backfill() -> int:
+    from . import db
+    from .models import DOCUMENT_MODELS
+    from .settings import get_settings
+
+    await db.connect(get_settings(), DOCUMENT_MODELS, sync_indexes=False)
+    print(f"Recipe: {await backfill_masks()} documents updated")
+    db.close()
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m server.allergens", description="dei0 recipe allergens")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backfill", help="compute allergen_mask of the recipes that miss it")
+    parser.parse_args(argv)
+    return asyncio.run(backfill())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
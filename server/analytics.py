@@ -0,0 +1,321 @@
+"""
+Population analytics over the user profiles: BMI distribution and habits, by state, gender or zipcode.
+
+Live statistics are two aggregations over the matching profiles, so Mongo
+returns a few rows per group instead of every profile: BMI is counted in bins
+of 0.1 (percentiles come from the bins) and every habit frequency is counted
+by value. With DEI0_ANALYTICS_ROLLUPS=true the same rows are kept per
+(state, gender) in the userprofile_rollups collection; profile writes mark
+their group stale and a refresh recomputes only the stale groups.
+
+ python -m server.analytics backfill   store bmi in the profiles written before it was stored
+ python -m server.analytics refresh    recompute the stale rollups (run it from cron)
+ python -m server.analytics rebuild    recompute every rollup
+"""
+import argparse
+import asyncio
+import math
+import sys
+from collections import Counter
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+from .models import BMI_EXPRESSION, Gender, HabitsProfile, USAStates, UserProfile
+from .settings import get_settings
+
+ROLLUP_COLLECTION = "userprofile_rollups"
+ROLLUP_DIMENSIONS = ("state", "gender")
+# profile fields the statistics depend on, writes of other fields leave the rollups alone
+STATS_FIELDS = ("state", "gender", "metric_unit", "height", "starting_weight", "habits_profile")
+
+BINS_PER_UNIT = 10  # bmi bins of 0.1
+PERCENTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+# WHO categories, upper bounds in kg/m2
+BMI_CATEGORIES = (("underweight", 18.5), ("normal", 25), ("overweight", 30), ("obese", math.inf))
+SMOKE = "smoke"
+HABIT_FREQUENCIES = tuple(name for name, field in HabitsProfile.model_fields.items() if field.annotation is int)
+
+
+class AnalyticsDimension(str, Enum):
+    STATE = 'state'
+    GENDER = 'gender'
+    ZIPCODE = 'zipcode'
+
+
+class AnalyticsSource(str, Enum):
+    LIVE = 'live'
+    ROLLUP = 'rollup'
+
+
+class BmiStats(BaseModel):
+    count: int = 0
+    mean: Optional[float] = None
+    stddev: Optional[float] = None
+    min: Optional[float] = None
+    max: Optional[float] = None
+    percentiles: Dict[str, float] = {}  # p10 ... p90, to 0.1
+    categories: Dict[str, int] = {}
+
+
+class HabitsStats(BaseModel):
+    count: int = 0  # profiles with a habits profile
+    smokers: int = 0
+    means: Dict[str, float] = {}
+    frequencies: Dict[str, Dict[int, int]] = {}  # habit -> value -> profiles
+
+
+class ProfileGroupStats(BaseModel):
+    group: Dict[str, Any]
+    bmi: BmiStats
+    habits: HabitsStats
+
+
+def stats_pipelines(match: Dict[str, Any], dimensions: Iterable[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    The aggregations of the statistics, each returns its rows through a cursor.
+
+    No $facet: its rows would come back inside one document, capped at 16 MB,
+    and grouping millions of profiles by zipcode goes well beyond.
+    """
+    key = {dimension: f"${dimension}" for dimension in dimensions}
+    return {
+        "bmi": [
+            {"$match": {**match, "bmi": {"$type": "number"}}},
+            {"$group": {
+                "_id": {**key, "bin": {"$floor": {"$multiply": ["$bmi", BINS_PER_UNIT]}}},
+                "count": {"$sum": 1},
+                "sum": {"$sum": "$bmi"},
+                "sum_sq": {"$sum": {"$multiply": ["$bmi", "$bmi"]}},
+                "min": {"$min": "$bmi"},
+                "max": {"$max": "$bmi"},
+            }},
+        ],
+        # one row per group, habit and value; every habits profile has smoke, its rows count the profiles
+        "habits": [
+            {"$match": {**match, "habits_profile": {"$type": "object"}}},
+            {"$project": {**dict.fromkeys(key, 1), "habit": {"$objectToArray": "$habits_profile"}}},
+            {"$unwind": "$habit"},
+            {"$match": {"habit.k": {"$in": [SMOKE, *HABIT_FREQUENCIES]}}},
+            {"$group": {"_id": {**key, "habit": "$habit.k", "value": "$habit.v"}, "count": {"$sum": 1}}},
+        ],
+    }
+
+
+def row_key(row: Dict[str, Any]) -> Dict[str, Any]:
+    # a $group on no dimension gives _id null
+    return row["_id"] or {}
+
+
+class GroupAccumulator:
+    """Adds up the rows of one group, rows of several groups (rollups) merge by addition."""
+
+    def __init__(self):
+        self.bins: Counter = Counter()
+        self.count = 0
+        self.sum = self.sum_sq = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+        self.habits = self.smokers = 0
+        self.frequencies: Dict[str, Counter] = {habit: Counter() for habit in HABIT_FREQUENCIES}
+
+    def add_bmi(self, row: Dict[str, Any]):
+        self.bins[int(row["_id"]["bin"])] += row["count"]
+        self.count += row["count"]
+        self.sum += row["sum"]
+        self.sum_sq += row["sum_sq"]
+        self.min = row["min"] if self.min is None else min(self.min, row["min"])
+        self.max = row["max"] if self.max is None else max(self.max, row["max"])
+
+    def add_habit(self, row: Dict[str, Any]):
+        habit, value = row["_id"].get("habit"), row["_id"].get("value")
+        if habit == SMOKE:
+            self.habits += row["count"]
+            if value:
+                self.smokers += row["count"]
+        elif habit in self.frequencies and value is not None:
+            self.frequencies[habit][value] += row["count"]
+
+    def percentile(self, fraction: float) -> float:
+        # nearest rank over the bins, the middle of the bin clamped to the real min/max
+        rank, seen = max(1, math.ceil(fraction * self.count)), 0
+        for bin_number in sorted(self.bins):
+            seen += self.bins[bin_number]
+            if seen >= rank:
+                return round(min(max((bin_number + 0.5) / BINS_PER_UNIT, self.min), self.max), 1)
+        return round(self.max, 1)
+
+    def bmi_stats(self) -> BmiStats:
+        if not self.count:
+            return BmiStats()
+        mean = self.sum / self.count
+        categories, lower = {}, -math.inf
+        for name, upper in BMI_CATEGORIES:
+            categories[name] = sum(count for bin_number, count in self.bins.items()
+                                   if lower * BINS_PER_UNIT <= bin_number < upper * BINS_PER_UNIT)
+            lower = upper
+        return BmiStats(
+            count=self.count, mean=round(mean, 2), stddev=round(math.sqrt(max(self.sum_sq / self.count - mean ** 2, 0)), 2),
+            min=round(self.min, 2), max=round(self.max, 2),
+            percentiles={f"p{round(fraction * 100)}": self.percentile(fraction) for fraction in PERCENTILES},
+            categories=categories,
+        )
+
+    def habits_stats(self) -> HabitsStats:
+        means = {habit: round(sum(value * count for value, count in values.items()) / self.habits, 2)
+                 for habit, values in self.frequencies.items() if self.habits}
+        frequencies = {habit: dict(sorted(values.items())) for habit, values in self.frequencies.items()}
+        return HabitsStats(count=self.habits, smokers=self.smokers, means=means, frequencies=frequencies)
+
+
+class GroupedStats:
+    """Rows of the stats pipelines added as they are read, by group."""
+
+    def __init__(self, dimensions: Tuple[str, ...]):
+        self.dimensions = dimensions
+        self.groups: Dict[Tuple, GroupAccumulator] = {}
+
+    def add(self, pipeline: str, row: Dict[str, Any]):
+        key = tuple(row_key(row).get(dimension) for dimension in self.dimensions)
+        group = self.groups.setdefault(key, GroupAccumulator())
+        if pipeline == "bmi":
+            group.add_bmi(row)
+        else:
+            group.add_habit(row)
+
+    def results(self) -> List[ProfileGroupStats]:
+        return [
+            ProfileGroupStats(group=dict(zip(self.dimensions, key)), bmi=group.bmi_stats(), habits=group.habits_stats())
+            for key, group in sorted(self.groups.items(), key=lambda item: tuple(str(value) for value in item[0]))
+        ]
+
+
+def profile_match(state: Optional[USAStates], gender: Optional[Gender], zipcode: Optional[int]) -> Dict[str, Any]:
+    filters = {"state": state, "gender": gender, "zipcode": zipcode}
+    return {name: value.value if isinstance(value, Enum) else value for name, value in filters.items() if value is not None}
+
+
+async def live_stats(match: Dict[str, Any], dimensions: Tuple[str, ...]) -> List[ProfileGroupStats]:
+    stats = GroupedStats(dimensions)
+    for name, pipeline in stats_pipelines(match, dimensions).items():
+        async for row in UserProfile.get_motor_collection().aggregate(pipeline):
+            stats.add(name, row)
+    return stats.results()
+
+
+def rollup_collection():
+    return UserProfile.get_motor_collection().database[ROLLUP_COLLECTION]
+
+
+async def rollup_stats(match: Dict[str, Any], dimensions: Tuple[str, ...]) -> List[ProfileGroupStats]:
+    if "zipcode" in match or "zipcode" in dimensions:
+        raise HTTPException(status_code=400, detail="rollups are kept by state and gender, use source=live for zipcode")
+    query = {f"_id.{name}": value for name, value in match.items()}
+    stats = GroupedStats(dimensions)
+    async for rollup in rollup_collection().find(query, {"stats": 1}):
+        # the rows of a rollup are grouped by bin/habit only, the group comes from its _id
+        for name, rows in rollup.get("stats", {}).items():
+            for row in rows:
+                stats.add(name, {**row, "_id": {**rollup["_id"], **row_key(row)}})
+    return stats.results()
+
+
+async def profile_stats(dimensions: Iterable[AnalyticsDimension], state: Optional[USAStates] = None,
+                        gender: Optional[Gender] = None, zipcode: Optional[int] = None,
+                        source: Optional[AnalyticsSource] = None) -> List[ProfileGroupStats]:
+    dimensions = tuple(dict.fromkeys(dimension.value for dimension in dimensions))
+    match = profile_match(state, gender, zipcode)
+    if source is None:
+        source = AnalyticsSource.ROLLUP if get_settings().analytics_rollups else AnalyticsSource.LIVE
+    if source == AnalyticsSource.ROLLUP:
+        return await rollup_stats(match, dimensions)
+    return await live_stats(match, dimensions)
+
+
+#######################################
+######  ROLLUPS   ########
+#######################################
+def rollup_id(profile: Any) -> Dict[str, str]:
+    # same key order everywhere, _id documents only match field by field in order
+    return {dimension: getattr(profile, dimension).value for dimension in ROLLUP_DIMENSIONS}
+
+
+def may_change_group(fields: Iterable[str]) -> bool:
+    """Whether a write of these fields may move the profile to another rollup group."""
+    return get_settings().analytics_rollups and bool(set(fields) & set(ROLLUP_DIMENSIONS))
+
+
+async def mark_stale(*profiles: Any, fields: Optional[Iterable[str]] = None):
+    """Called after a profile write with the groups it left and entered; fields: the written fields, if not all."""
+    if not get_settings().analytics_rollups:
+        return
+    if fields is not None and not set(fields) & set(STATS_FIELDS):
+        return
+    for group_id in {tuple(rollup_id(profile).items()) for profile in profiles if profile is not None}:
+        await rollup_collection().update_one({"_id": dict(group_id)}, {"$set": {"stale": True}}, upsert=True)
+
+
+async def refresh_rollups(everything: bool = False) -> int:
+    """
+    Recompute the stale rollups, every rollup with everything=True.
+
+    The stale mark is cleared before the group is read, a write arriving in
+    the meantime marks it again and the next refresh picks it up.
+    """
+    rollups = rollup_collection()
+    if everything:
+        groups = UserProfile.get_motor_collection().aggregate(
+            [{"$group": {"_id": {dimension: f"${dimension}" for dimension in ROLLUP_DIMENSIONS}}}])
+        async for group in groups:
+            await rollups.update_one({"_id": group["_id"]}, {"$set": {"stale": True}}, upsert=True)
+        await rollups.update_many({}, {"$set": {"stale": True}})
+    refreshed = 0
+    async for rollup in rollups.find({"stale": True}, {"_id": 1}):
+        group_id = rollup["_id"]
+        await rollups.update_one({"_id": group_id}, {"$set": {"stale": False}})
+        # a single (state, gender) group: a few hundred rows at most, kept in one document
+        stats = {name: await UserProfile.get_motor_collection().aggregate(pipeline).to_list(None)
+                 for name, pipeline in stats_pipelines(dict(group_id), ()).items()}
+        if not stats["bmi"]:
+            await rollups.delete_one({"_id": group_id, "stale": False})
+        else:
+            await rollups.update_one({"_id": group_id}, {"$set": {"stats": stats, "refreshed_at": datetime.utcnow()}})
+        refreshed += 1
+    return refreshed
+
+
+async def backfill_bmi() -> int:
+    # one update on the server, bmi computed from the stored height, weight and unit
+    result = await UserProfile.get_motor_collection().update_many(
+        {"bmi": {"$exists": False}}, [{"$set": {"bmi": BMI_EXPRESSION}}])
+    return result.modified_count
+
+
+async def run(command: str) -> int:
+    from . import db
+    from .models import DOCUMENT_MODELS
+
+    await db.connect(get_settings(), DOCUMENT_MODELS, sync_indexes=False)
+    if command == "backfill":
+        print(f"UserProfile: {await backfill_bmi()} documents updated")
+    else:
+        print(f"{await refresh_rollups(everything=command == 'rebuild')} rollups refreshed")
+    db.close()
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m server.analytics", description="dei0 user profile analytics")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backfill", help="store bmi in the profiles that miss it")
+    commands.add_parser("refresh", help="recompute the stale rollups")
+    commands.add_parser("rebuild", help="recompute every rollup")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args.command))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,62 @@
 from fastapi import FastAPI
-from motor.motor_asyncio import AsyncIOMotorClient
-from beanie import init_beanie
-from .models import Ingredient, Recipe, MealPlan, User, UserProfile
-from .routes import ingredients_router, recipes_router, mealplans_router, users_router, userprofiles_router
+from . import db
+from .settings import get_settings
+from .models import DOCUMENT_MODELS, User
+from .routes import ingredients_router, recipes_router, mealplans_router, users_router, userprofiles_router, analytics_router, changes_router
 from fastapi import Depends
 from .models import UserCreate, UserRead, UserUpdate
 from .users import auth_backend, current_active_user, fastapi_users
+from .metrics import MetricsMiddleware, metrics_endpoint
+from .admission import AdmissionMiddleware, admission_classes, mongo_error_handler
+from pymongo.errors import PyMongoError
+from .changes import change_feed
+from .queryplans import RouteContextMiddleware, inspector, query_plans_endpoint
 
 app = FastAPI()
 
 @app.on_event("startup")
 async def start_beanie():
-    # CREATE MOTOR CLIENT
-    client = AsyncIOMotorClient( "mongodb://localhost:27017/dei0", uuidRepresentation="standard" )
-    await init_beanie(client.dei0, document_models=[Ingredient, Recipe, MealPlan, User, UserProfile])
- 
-    app.include_router(ingredients_router, prefix="/meals", tags=["ingredient"],dependencies=[Depends(current_active_user)])  
-    app.include_router(recipes_router, prefix="/meals", tags=["recipe"],dependencies=[Depends(current_active_user)])  
-    app.include_router(mealplans_router, prefix="/meals", tags=["meal_plan"],dependencies=[Depends(current_active_user)])  
-    app.include_router(users_router, prefix="/meals", tags=["user"],dependencies=[Depends(current_active_user)])  
-    app.include_router(userprofiles_router, prefix="/meals", tags=["user_profile"],dependencies=[Depends(current_active_user)]) 
+    # CREATE MOTOR CLIENT, INIT BEANIE AND OPEN THE POOL
+    # runs in every worker process before it accepts requests
+    settings = get_settings()
+    client = await db.connect(settings, document_models=DOCUMENT_MODELS)
+    if settings.query_plans:
+        inspector.start(client, settings.query_plan_max_ratio, settings.query_plan_min_docs_examined)
+    if settings.change_feed:
+        change_feed.start(client[settings.mongodb_database], settings.change_feed_buffer)
+
+@app.on_event("shutdown")
+async def stop_beanie():
+    inspector.stop()
+    change_feed.stop()
+    db.close()
+
+# routers are registered at import time so a preloaded app is complete before the workers fork
+settings = get_settings()
+catalog_reads = db.route_reads(db.ReadOptions(settings.catalog_read_preference, settings.catalog_read_concern))
+
+app.include_router(ingredients_router, prefix="/meals", tags=["ingredient"],dependencies=[Depends(current_active_user), Depends(catalog_reads)])  
+app.include_router(recipes_router, prefix="/meals", tags=["recipe"],dependencies=[Depends(current_active_user), Depends(catalog_reads)])  
+app.include_router(mealplans_router, prefix="/meals", tags=["meal_plan"],dependencies=[Depends(current_active_user)])  
+app.include_router(users_router, prefix="/meals", tags=["user"],dependencies=[Depends(current_active_user)])  
+app.include_router(userprofiles_router, prefix="/meals", tags=["user_profile"],dependencies=[Depends(current_active_user)]) 
+app.include_router(analytics_router, prefix="/meals", tags=["analytics"],dependencies=[Depends(current_active_user), Depends(catalog_reads)])
+app.include_router(changes_router, prefix="/meals", tags=["changes"],dependencies=[Depends(current_active_user)])
+
+if settings.admission_control or settings.request_timeout_ms:
+    # added before the metrics middleware so the 503s are measured too
+    classes = admission_classes(settings) if settings.admission_control else []
+    app.add_middleware(AdmissionMiddleware, classes=classes, request_timeout_ms=settings.request_timeout_ms,
+                       retry_after=settings.retry_after)
+    app.add_exception_handler(PyMongoError, mongo_error_handler)
+
+if settings.metrics:
+    app.add_middleware(MetricsMiddleware)
+    app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+
+if settings.query_plans:
+    app.add_middleware(RouteContextMiddleware)
+    app.add_route("/query-plans", query_plans_endpoint, include_in_schema=False)
 
 app.include_router(
     fastapi_users.get_auth_router(auth_backend), prefix="/auth/jwt", tags=["auth"]
@@ -0,0 +1,287 @@
+import codecs
+import json
+from enum import Enum
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Type
+from uuid import uuid4
+
+from beanie import Document
+from beanie.odm.actions import ActionDirections, ActionRegistry, EventTypes
+from beanie.odm.utils.dump import get_dict
+from bson import ObjectId
+from fastapi import Request
+from pydantic import BaseModel, ValidationError
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+BULK_CHUNK_SIZE = 500
+MAX_ITEM_BYTES = 1024 * 1024  # a single item larger than this makes the body malformed
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+# fields kept from the first insert when an upsert updates an existing document
+INSERT_ONLY_FIELDS = ("created_at",)
+
+
+class BulkItemStatus(str, Enum):
+    CREATED = 'created'
+    UPDATED = 'updated'
+    ERROR = 'error'
+
+
+class BulkItemResult(BaseModel):
+    index: int
+    status: BulkItemStatus
+    id: Optional[str] = None
+    detail: Optional[str] = None
+
+
+class BulkReport(BaseModel):
+    created: int = 0
+    updated: int = 0
+    failed: int = 0
+    items: List[BulkItemResult] = []
+
+    def add(self, result: BulkItemResult):
+        self.items.append(result)
+        if result.status == BulkItemStatus.CREATED:
+            self.created += 1
+        elif result.status == BulkItemStatus.UPDATED:
+            self.updated += 1
+        else:
+            self.failed += 1
+
+
+class MalformedBody(ValueError):
+    pass
+
+
+class MalformedItem:
+    """Yielded in place of an NDJSON line that is not JSON, reported as that item's error."""
+
+    def __init__(self, detail: str):
+        self.detail = detail
+
+
+def parse_line(line: bytes) -> Any:
+    try:
+        return json.loads(line)
+    except ValueError as error:  # JSONDecodeError and UnicodeDecodeError
+        return MalformedItem(f"malformed item: {error}")
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield parse_line(line)
+        if len(buffer) > MAX_ITEM_BYTES:
+            raise MalformedBody(f"line longer than {MAX_ITEM_BYTES} bytes")
+    if buffer.strip():
+        yield parse_line(buffer)
+
+
+class JsonArrayParser:
+    """
+    Incremental parser of "[{...}, {...}]", items come out as soon as they are complete.
+
+    Only the text of the item being read is kept, so the whole body is never
+    held in memory. After "[" comes a value or "]", after a value exactly one
+    "," or "]", after the closing "]" only whitespace.
+    """
+    EXPECT_ARRAY, EXPECT_FIRST, EXPECT_ITEM, EXPECT_SEPARATOR, AFTER_ARRAY = range(5)
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.state = self.EXPECT_ARRAY
+
+    @property
+    def finished(self) -> bool:
+        return self.state == self.AFTER_ARRAY
+
+    def feed(self, text: str, final: bool = False) -> Iterator[Any]:
+        self.buffer += text
+        position = 0
+        try:
+            while True:
+                while position < len(self.buffer) and self.buffer[position].isspace():
+                    position += 1
+                if position == len(self.buffer):
+                    break
+                char = self.buffer[position]
+                if self.state == self.EXPECT_ARRAY:
+                    if char != "[":
+                        raise MalformedBody("body must be a JSON array or NDJSON")
+                    self.state = self.EXPECT_FIRST
+                elif self.state == self.AFTER_ARRAY:
+                    raise MalformedBody("unexpected data after the JSON array")
+                elif self.state == self.EXPECT_SEPARATOR:
+                    if char not in ",]":
+                        raise MalformedBody(f"expected ',' or ']' at character {position}, got {char!r}")
+                    self.state = self.EXPECT_ITEM if char == "," else self.AFTER_ARRAY
+                elif char == "]" and self.state == self.EXPECT_FIRST:
+                    self.state = self.AFTER_ARRAY
+                elif char in ",]":
+                    raise MalformedBody(f"expected a value, got {char!r}")
+                else:
+                    try:
+                        item, end = self.decoder.raw_decode(self.buffer, position)
+                    except json.JSONDecodeError as error:
+                        # incomplete item, wait for the next chunk, unless no valid item can be that long
+                        if final or self.pending_bytes(position) > MAX_ITEM_BYTES:
+                            raise MalformedBody(f"malformed item or item larger than {MAX_ITEM_BYTES} bytes: {error}")
+                        break
+                    if end == len(self.buffer) and not final and isinstance(item, (int, float)):
+                        break  # the number may go on in the next chunk
+                    position = end
+                    self.state = self.EXPECT_SEPARATOR
+                    yield item
+                    continue
+                position += 1
+        finally:
+            self.buffer = self.buffer[position:]
+
+    def pending_bytes(self, position: int) -> int:
+        pending = len(self.buffer) - position
+        # a character is 1 to 4 bytes in utf-8, encode only when it may matter
+        if pending * 4 <= MAX_ITEM_BYTES:
+            return pending
+        return len(self.buffer[position:].encode())
+
+
+async def iter_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    parser = JsonArrayParser()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    async for chunk in chunks:
+        for item in parser.feed(text_decoder.decode(chunk)):
+            yield item
+    for item in parser.feed(text_decoder.decode(b"", final=True), final=True):
+        yield item
+    if not parser.finished:
+        raise MalformedBody("body is not a complete JSON array")
+
+
+def iter_request_items(request: Request) -> AsyncIterator[Any]:
+    media_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if media_type in NDJSON_MEDIA_TYPES:
+        return iter_ndjson(request.stream())
+    return iter_json_array(request.stream())
+
+
+CheckChunk = Callable[[List[Document]], Awaitable[Dict[int, str]]]
+AfterUpdate = Callable[[List[ObjectId]], Awaitable[None]]
+
+
+async def stored_ids(model: Type[Document], names: List[str]) -> Dict[str, ObjectId]:
+    """_id of the stored document of every name, the oldest when several share it."""
+    ids: Dict[str, ObjectId] = {}
+    cursor = model.get_motor_collection().find({"name": {"$in": names}}, {"name": 1}).sort("_id", 1)
+    async for stored in cursor:
+        ids.setdefault(stored["name"], stored["_id"])
+    return ids
+
+
+def build_operation(document: Document, upsert: bool, stored_id: Optional[ObjectId] = None):
+    fields = get_dict(document, to_db=True)
+    if document.get_settings().use_revision:
+        fields["revision_id"] = uuid4()
+    if not upsert:
+        fields.setdefault("_id", ObjectId())
+        return InsertOne(fields), fields["_id"]
+    fields.pop("_id", None)
+    on_insert = {key: fields.pop(key) for key in INSERT_ONLY_FIELDS if key in fields}
+    update = {"$set": fields}
+    if on_insert:
+        update["$setOnInsert"] = on_insert
+    if stored_id is not None:
+        # the document read before the write, so the updated _id is known
+        return UpdateOne({"_id": stored_id, "name": fields["name"]}, update, upsert=True), stored_id
+    return UpdateOne({"name": fields["name"]}, update, upsert=True), None
+
+
+async def write_chunk(model: Type[Document], chunk: List[Tuple[int, Any]], upsert: bool,
+                      report: BulkReport, check: Optional[CheckChunk] = None) -> List[Document]:
+    """Writes the chunk, returns the _id of the documents it updated (upserts that found one)."""
+    documents = []
+    for index, item in chunk:
+        if isinstance(item, MalformedItem):
+            report.add(BulkItemResult(index=index, status=BulkItemStatus.ERROR, detail=item.detail))
+            continue
+        try:
+            documents.append((index, model.model_validate(item)))
+        except ValidationError as error:
+            report.add(BulkItemResult(index=index, status=BulkItemStatus.ERROR, detail=str(error)))
+
+    if check is not None and documents:
+        rejected = await check([document for _, document in documents])
+        for position in sorted(rejected, reverse=True):
+            index, _ = documents.pop(position)
+            report.add(BulkItemResult(index=index, status=BulkItemStatus.ERROR, detail=rejected[position]))
+
+    if not documents:
+        return []
+    for _, document in documents:
+        # same before-insert hooks as Document.insert (derived fields such as recipe nutrition)
+        await ActionRegistry.run_actions(document, EventTypes.INSERT, ActionDirections.BEFORE, exclude=[])
+    ids = await stored_ids(model, [document.name for _, document in documents]) if upsert else {}
+    operations, written_ids = zip(*(build_operation(document, upsert, ids.get(document.name))
+                                    for _, document in documents))
+    errors: Dict[int, str] = {}
+    try:
+        result = await model.get_motor_collection().bulk_write(list(operations), ordered=False)
+        upserted = result.upserted_ids
+    except BulkWriteError as error:
+        errors = {write_error["index"]: write_error["errmsg"] for write_error in error.details["writeErrors"]}
+        upserted = {item["index"]: item["_id"] for item in error.details.get("upserted", [])}
+
+    updated = []
+    for position, (index, document) in enumerate(documents):
+        if position in errors:
+            report.add(BulkItemResult(index=index, status=BulkItemStatus.ERROR, detail=errors[position]))
+        elif not upsert:
+            report.add(BulkItemResult(index=index, status=BulkItemStatus.CREATED, id=str(written_ids[position])))
+        elif position in upserted:
+            report.add(BulkItemResult(index=index, status=BulkItemStatus.CREATED, id=str(upserted[position])))
+        elif written_ids[position] is not None:
+            report.add(BulkItemResult(index=index, status=BulkItemStatus.UPDATED, id=str(written_ids[position])))
+            updated.append(written_ids[position])
+        else:
+            # inserted by someone else between the read and the write, matched by name only
+            report.add(BulkItemResult(index=index, status=BulkItemStatus.UPDATED))
+    return updated
+
+
+async def bulk_import(model: Type[Document], items: AsyncIterator[Any], upsert: bool = False,
+                      check: Optional[CheckChunk] = None, after_update: Optional[AfterUpdate] = None,
+                      chunk_size: int = BULK_CHUNK_SIZE) -> BulkReport:
+    """
+    Write the items in unordered batches of chunk_size.
+
+    A failing item (validation, check or write error such as a duplicate
+    name) is reported and never aborts the rest of the batch. In upsert
+    mode documents are matched by name, and after_update gets the _id of
+    the documents every batch updated.
+    """
+    report = BulkReport()
+    chunk: List[Tuple[int, Any]] = []
+    index = 0
+
+    async def flush():
+        updated = await write_chunk(model, chunk, upsert, report, check)
+        if updated and after_update is not None:
+            await after_update(updated)
+
+    try:
+        async for item in items:
+            chunk.append((index, item))
+            index += 1
+            if len(chunk) == chunk_size:
+                await flush()
+                chunk = []
+    except MalformedBody as error:
+        report.add(BulkItemResult(index=index, status=BulkItemStatus.ERROR, detail=f"malformed body: {error}"))
+    if chunk:
+        await flush()
+    report.items.sort(key=lambda result: result.index)
+    return report
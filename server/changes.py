@@ -0,0 +1,261 @@
+"""
+Meal plan and user profile changes pushed to the clients as Server-Sent Events.
+
+Every worker follows one change stream (DEI0_CHANGE_FEED=true, Mongo must run
+as a replica set, a single node one is enough) and fans each change out to
+the subscribers connected to that worker. The id of every event is the change
+stream resume token: a client reconnecting with Last-Event-ID first gets what
+it missed, from the recent events kept in memory or, when older, from a
+change stream resumed at that token. If Mongo no longer has it, the client
+gets a reset event and has to reload.
+
+ GET /meals/changes[?collections=mealplans&ids=<_id>]   text/event-stream
+"""
+import asyncio
+from collections import deque
+from enum import Enum
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Set
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .conditional import DocumentStamp, stamp_etag
+from .fastjson import dumps
+from .models import MealPlan, User, UserProfile, UserRole
+
+KEEPALIVE_SECONDS = 15
+RETRY_MS = 3000  # reconnection delay announced to EventSource clients
+FEED_RETRY_SECONDS = 2
+CATCH_UP_LIMIT = 10000  # older than this many events a reconnecting client reloads instead
+OPERATIONS = ("insert", "update", "replace", "delete")
+HISTORY_LOST_CODES = (280, 286)  # ChangeStreamFatalError, ChangeStreamHistoryLost
+# roles that see the changes of every profile, the others only see their own
+PROFILE_READERS = (UserRole.ADMIN, UserRole.GESTOR)
+
+KEEPALIVE_FRAME = b": keepalive\n\n"
+RESET_FRAME = b"event: reset\ndata: {}\n\n"
+
+
+class FeedCollection(str, Enum):
+    MEALPLANS = 'mealplans'
+    USERPROFILES = 'userprofiles'
+
+
+FEED_MODELS = {FeedCollection.MEALPLANS: MealPlan, FeedCollection.USERPROFILES: UserProfile}
+
+
+class ChangeEvent:
+    """A change, encoded once as an SSE frame shared by every subscriber."""
+    __slots__ = ("token", "collection", "document_id", "owner", "frame")
+
+    def __init__(self, token: Optional[str], collection: Optional[FeedCollection], document_id: Optional[str],
+                 owner: Optional[str], frame: bytes):
+        self.token = token
+        self.collection = collection
+        self.document_id = document_id
+        self.owner = owner
+        self.frame = frame
+
+
+RESET = ChangeEvent(None, None, None, None, RESET_FRAME)
+
+
+def change_event(change: Dict[str, Any], collections: Dict[str, FeedCollection]) -> Optional[ChangeEvent]:
+    collection = collections.get(change.get("ns", {}).get("coll"))
+    if collection is None or change["operationType"] not in OPERATIONS:
+        return None
+    token = change["_id"]["_data"]
+    document = change.get("fullDocument")  # the document after the change, None for deletes
+    document_id = str(change["documentKey"]["_id"])
+    payload = {
+        "collection": collection.value,
+        "operation": change["operationType"],
+        "_id": document_id,
+        "etag": stamp_etag(DocumentStamp.model_validate(document)) if document else None,
+        "document": document,
+    }
+    frame = b"id: " + token.encode() + b"\nevent: change\ndata: " + dumps(payload) + b"\n\n"
+    # a deleted profile has no document left to tell its owner, only PROFILE_READERS get that event
+    owner = document.get("user_id") if document and collection == FeedCollection.USERPROFILES else None
+    return ChangeEvent(token, collection, document_id, owner, frame)
+
+
+class Subscription:
+    """Events waiting for one client; a client too slow to keep up is disconnected and catches up on reconnect."""
+
+    def __init__(self, user: User, collections: Set[FeedCollection], ids: Set[str], max_pending: int):
+        self.user = user
+        self.collections = collections
+        self.ids = ids
+        self.max_pending = max_pending
+        self.pending: Deque[ChangeEvent] = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+    def wants(self, event: ChangeEvent) -> bool:
+        if event is RESET:
+            return True
+        if event.collection not in self.collections or (self.ids and event.document_id not in self.ids):
+            return False
+        if event.collection == FeedCollection.USERPROFILES and self.user.role not in PROFILE_READERS:
+            return event.owner == str(self.user.id)
+        return True
+
+    def push(self, event: ChangeEvent):
+        if len(self.pending) >= self.max_pending:
+            self.overflowed = True
+        else:
+            self.pending.append(event)
+        self.ready.set()
+
+    async def next_events(self, timeout: float) -> List[ChangeEvent]:
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self.ready.clear()
+        events = list(self.pending)
+        self.pending.clear()
+        return events
+
+
+class ChangeFeed:
+    def __init__(self, buffer_size: int = 1000, max_pending: int = 1000):
+        self.recent: Deque[ChangeEvent] = deque(maxlen=buffer_size)
+        self.max_pending = max_pending
+        self.subscriptions: Set[Subscription] = set()
+        self.resume_token: Optional[Dict[str, Any]] = None
+        self._collections: Dict[str, FeedCollection] = {}
+        self._database = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        # a feed task that died is not running, the endpoint answers 503 instead of silent streams
+        return self._task is not None and not self._task.done()
+
+    def start(self, database, buffer_size: Optional[int] = None):
+        if buffer_size is not None:
+            self.recent = deque(maxlen=buffer_size)
+        self._database = database
+        self._collections = {model.get_motor_collection().name: name for name, model in FEED_MODELS.items()}
+        self._task = asyncio.create_task(self._follow())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def watch(self, resume_after: Optional[Dict[str, Any]] = None, **options):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(self._collections)}, "operationType": {"$in": list(OPERATIONS)}}}]
+        return self._database.watch(pipeline, full_document="updateLookup", resume_after=resume_after, **options)
+
+    async def _follow(self):
+        while True:
+            try:
+                async with self.watch(self.resume_token) as stream:
+                    async for change in stream:
+                        self.publish(change)
+            except OperationFailure as error:
+                print(f"change feed: {error}, restarting")
+                if error.code in HISTORY_LOST_CODES:
+                    # the token fell off the oplog: what happened since is lost, every client reloads
+                    self.resume_token = None
+                    self.reset()
+                await asyncio.sleep(FEED_RETRY_SECONDS)
+            except PyMongoError as error:
+                # pymongo already resumed what it could, try again from the last token
+                print(f"change feed: {error}, retrying")
+                await asyncio.sleep(FEED_RETRY_SECONDS)
+            except Exception as error:
+                # a change that cannot be decoded or encoded must not stop the feed, publish already moved past it
+                print(f"change feed: {error!r}, retrying")
+                await asyncio.sleep(FEED_RETRY_SECONDS)
+
+    def publish(self, change: Dict[str, Any]):
+        self.resume_token = change["_id"]
+        event = change_event(change, self._collections)
+        if event is None:
+            return
+        self.recent.append(event)
+        for subscription in self.subscriptions:
+            if subscription.wants(event):
+                subscription.push(event)
+
+    def reset(self):
+        self.recent.clear()
+        for subscription in self.subscriptions:
+            subscription.push(RESET)
+
+    def subscribe(self, user: User, collections: Set[FeedCollection], ids: Set[str]) -> Subscription:
+        subscription = Subscription(user, collections, ids, self.max_pending)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    def events_after(self, token: str) -> Optional[List[ChangeEvent]]:
+        """Events kept in memory after that one, None when it is not among them."""
+        for position, event in enumerate(self.recent):
+            if event.token == token:
+                return list(self.recent)[position + 1:]
+        return None
+
+    async def catch_up(self, token: str) -> Optional[List[ChangeEvent]]:
+        """Events after that token read from a change stream resumed at it, None when Mongo no longer has it."""
+        events = []
+        try:
+            async with self.watch({"_data": token}, max_await_time_ms=100) as stream:
+                while True:
+                    change = await stream.try_next()
+                    if change is None:
+                        break
+                    if len(events) == CATCH_UP_LIMIT:
+                        return None
+                    event = change_event(change, self._collections)
+                    if event is not None:
+                        events.append(event)
+        except OperationFailure:
+            return None
+        return events
+
+
+change_feed = ChangeFeed()
+
+
+async def event_stream(feed: ChangeFeed, user: User, collections: Set[FeedCollection], ids: Set[str],
+                       last_event_id: Optional[str]) -> AsyncIterator[bytes]:
+    """
+    SSE frames for one client: what it missed since last_event_id, then the live events.
+
+    The subscription is registered when the response starts streaming, before
+    the catch-up; the live events that overlap it are skipped by token
+    (resume tokens sort in change order).
+    """
+    subscription = feed.subscribe(user, collections, ids)
+    try:
+        yield f"retry: {RETRY_MS}\n\n".encode()
+        last = last_event_id
+        if last_event_id:
+            missed = feed.events_after(last_event_id)
+            if missed is None:
+                missed = await feed.catch_up(last_event_id)
+            if missed is None:
+                yield RESET_FRAME
+                last = None
+            for event in missed or ():
+                if subscription.wants(event):
+                    yield event.frame
+                last = event.token
+        while True:
+            events = await subscription.next_events(KEEPALIVE_SECONDS)
+            if subscription.overflowed:
+                return  # the client reconnects with the id of the last frame it got
+            if not events:
+                yield KEEPALIVE_FRAME
+            for event in events:
+                if event is RESET or last is None or event.token > last:
+                    yield event.frame
+                    last = event.token or last
+    finally:
+        feed.unsubscribe(subscription)
@@ -0,0 +1,136 @@
+import hashlib
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional, Tuple, Type
+from uuid import UUID
+
+from beanie import Document, PydanticObjectId
+from fastapi import HTTPException, Response
+from pydantic import BaseModel, Field
+
+
+class DocumentStamp(BaseModel):
+    """Projection read to compute an ETag without loading the document."""
+    id: PydanticObjectId = Field(alias="_id")
+    updated_at: Optional[datetime] = None
+    revision_id: Optional[UUID] = None
+
+
+def document_stamp(document: Any) -> DocumentStamp:
+    """Stamp of a document as read, a Motor dict, a projection or a loaded Document."""
+    if isinstance(document, dict):
+        return DocumentStamp.model_validate(document)
+    if isinstance(document, Document):
+        # the stored revision, beanie swaps a fresh one into loaded documents
+        revision_id = document._previous_revision_id
+    else:
+        revision_id = getattr(document, "revision_id", None)
+    # a default filled in at parse time (updated_at of old documents) is not what mongo holds
+    updated_at = getattr(document, "updated_at", None) if "updated_at" in document.model_fields_set else None
+    return DocumentStamp(_id=document.id, updated_at=updated_at, revision_id=revision_id)
+
+
+def stamp_fields(model: Type[Document]) -> Tuple[str, ...]:
+    """Fields an ETag is computed from, besides _id."""
+    fields = ("revision_id",) if uses_revision(model) else ()
+    if "updated_at" in model.model_fields:
+        fields += ("updated_at",)
+    return fields
+
+
+def missing_stamp_fields(model: Type[Document], fields: Tuple[str, ...]) -> Tuple[str, ...]:
+    """Stamp fields a projection also has to read to tag what it returns, left out of the body."""
+    return tuple(name for name in stamp_fields(model) if name not in fields)
+
+
+def uses_revision(model: Type[Document]) -> bool:
+    return model.get_settings().use_revision
+
+
+def is_versioned(model: Type[Document]) -> bool:
+    return uses_revision(model) or "updated_at" in model.model_fields
+
+
+def revision_etag(revision_id: UUID) -> str:
+    return f'"{revision_id}"'
+
+
+def stored_revision_etag(document: Document) -> str:
+    # beanie hands loaded documents a fresh revision_id for their next save, the stored one is kept aside
+    return revision_etag(document._previous_revision_id)
+
+
+def make_etag(stamps: Iterable[DocumentStamp], fields: Optional[Tuple[str, ...]] = None) -> str:
+    # mongo keeps milliseconds, so the stamp is truncated to match what is read back
+    digest = hashlib.sha1(("*" if fields is None else ",".join(fields)).encode())
+    for stamp in stamps:
+        if stamp.revision_id is not None:
+            version = str(stamp.revision_id)
+        else:
+            version = stamp.updated_at.isoformat(timespec="milliseconds") if stamp.updated_at else ""
+        digest.update(f"|{stamp.id}:{version}".encode())
+    return f'"{digest.hexdigest()}"'
+
+
+async def revision_condition(model: Type[Document], document_id: PydanticObjectId, if_match: str) -> Dict[str, Any]:
+    """
+    Filter matching only the revision the client sent back in If-Match.
+
+    The ETag of a revisioned document is its quoted revision_id. A document
+    written before revisions were enabled has none and carries the hash
+    ETag instead: it matches while the document still has no revision,
+    every write through the API sets one.
+    """
+    value = if_match.strip().removeprefix("W/")
+    try:
+        return {"revision_id": UUID(value.strip('"'))}
+    except ValueError:
+        pass
+    stamp = await model.find_one({"_id": document_id}).project(DocumentStamp)
+    if stamp is None:
+        return {}  # the update finds nothing and answers 404
+    if stamp.revision_id is None and make_etag([stamp]) == value:
+        return {"revision_id": None, "updated_at": stamp.updated_at} if stamp.updated_at else {"revision_id": None}
+    raise HTTPException(status_code=412, detail="If-Match does not match the current revision")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in [candidate.removeprefix("W/") for candidate in candidates]
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+async def document_etag(model: Type[Document], document_id: PydanticObjectId,
+                        fields: Optional[Tuple[str, ...]] = None) -> Optional[str]:
+    stamp = await model.find_one({"_id": document_id}).project(DocumentStamp)
+    if stamp is None:
+        return None
+    return stamp_etag(stamp, fields)
+
+
+def stamp_etag(stamp: DocumentStamp, fields: Optional[Tuple[str, ...]] = None) -> str:
+    # the whole document is tagged with its revision, which is what If-Match takes back
+    if stamp.revision_id is not None and fields is None:
+        return revision_etag(stamp.revision_id)
+    return make_etag([stamp], fields)
+
+
+async def check_document_etag(model: Type[Document], document_id: PydanticObjectId,
+                              fields: Optional[Tuple[str, ...]], if_none_match: Optional[str],
+                              not_found_detail: str) -> Tuple[str, Optional[Response]]:
+    """
+    Resolve the ETag of a document with a projection-only query.
+
+    Returns the ETag and, when the client copy is still valid, the 304
+    response to send instead of the document.
+    """
+    etag = await document_etag(model, document_id, fields)
+    if etag is None:
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    if etag_matches(if_none_match, etag):
+        return etag, not_modified(etag)
+    return etag, None
@@ -0,0 +1,120 @@
+import asyncio
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Type
+
+from beanie import Document, init_beanie
+from beanie.odm.utils.init import Initializer
+from fastapi import Request
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+
+from .metrics import mongo_listeners
+from .queryplans import inspector
+from .settings import Settings
+
+client: Optional[AsyncIOMotorClient] = None
+
+
+def create_client(settings: Settings) -> AsyncIOMotorClient:
+    options = {
+        "uuidRepresentation": "standard",
+        "appname": settings.app_name,
+        "maxPoolSize": settings.max_pool_size,
+        "minPoolSize": settings.min_pool_size,
+        "connectTimeoutMS": settings.connect_timeout_ms,
+        "serverSelectionTimeoutMS": settings.server_selection_timeout_ms,
+    }
+    optional = {
+        "maxIdleTimeMS": settings.max_idle_time_ms,
+        "waitQueueTimeoutMS": settings.wait_queue_timeout_ms,
+        "socketTimeoutMS": settings.socket_timeout_ms,
+        "compressors": settings.compressors,
+    }
+    options.update({key: value for key, value in optional.items() if value is not None})
+    listeners = mongo_listeners() if settings.metrics else []
+    if settings.query_plans:
+        listeners.append(inspector.listener)
+    if listeners:
+        options["event_listeners"] = listeners
+    return AsyncIOMotorClient(settings.mongodb_uri, **options)
+
+
+async def warm_up(motor_client: AsyncIOMotorClient, connections: int):
+    # concurrent pings make the pool open that many connections before traffic arrives
+    await motor_client.admin.command("ping")
+    if connections > 1:
+        await asyncio.gather(*(motor_client.admin.command("ping") for _ in range(connections)))
+
+
+class SkipIndexesInitializer(Initializer):
+    """Beanie initializer that leaves the indexes as they are (they are managed with server.indexes)."""
+
+    async def init_indexes(self, cls, allow_index_dropping: bool = False):
+        return None
+
+
+async def connect(settings: Settings, document_models: List[Type[Document]],
+                  sync_indexes: Optional[bool] = None, allow_index_dropping: bool = False) -> AsyncIOMotorClient:
+    global client
+    client = create_client(settings)
+    database = client[settings.mongodb_database]
+    if sync_indexes is None:
+        sync_indexes = settings.sync_indexes
+    if sync_indexes:
+        await init_beanie(database, document_models=document_models, allow_index_dropping=allow_index_dropping)
+    else:
+        await SkipIndexesInitializer(database=database, document_models=document_models)
+    await warm_up(client, settings.min_pool_size)
+    return client
+
+
+def close():
+    global client
+    if client is not None:
+        client.close()
+        client = None
+
+
+#######################################
+######  READ PREFERENCE   ########
+#######################################
+class ReadOptions:
+    """Read preference and read concern used by the reads of a request."""
+    def __init__(self, read_preference: str = "primary", read_concern: Optional[str] = None):
+        self.read_preference = make_read_preference(read_pref_mode_from_name(read_preference), None)
+        self.read_concern = ReadConcern(read_concern) if read_concern else None
+        self._collections: Dict[str, AsyncIOMotorCollection] = {}
+
+    def collection(self, base: AsyncIOMotorCollection) -> AsyncIOMotorCollection:
+        collection = self._collections.get(base.full_name)
+        if collection is None or collection.database is not base.database:
+            collection = base.with_options(read_preference=self.read_preference, read_concern=self.read_concern)
+            self._collections[base.full_name] = collection
+        return collection
+
+
+current_read_options: ContextVar[Optional[ReadOptions]] = ContextVar("current_read_options", default=None)
+
+
+def route_reads(options: ReadOptions):
+    """
+    Router dependency: GET requests of the router read with these options.
+
+    Other methods keep the client defaults, so a write and the reads it
+    depends on stay on the primary.
+    """
+    async def set_read_options(request: Request):
+        if request.method in ("GET", "HEAD"):
+            current_read_options.set(options)
+    return set_read_options
+
+
+class RoutedReads:
+    """Document mixin, the collection honors the read options of the current request."""
+
+    @classmethod
+    def get_motor_collection(cls) -> AsyncIOMotorCollection:
+        collection = super().get_motor_collection()
+        options = current_read_options.get()
+        return options.collection(collection) if options is not None else collection
@@ -0,0 +1,29 @@
+from typing import Any, AsyncIterator
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import Response
+
+
+def default(value: Any) -> Any:
+    # orjson handles datetime and UUID itself, ObjectId is the only BSON type left in our documents
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=default)
+
+
+class RawJSONResponse(Response):
+    """JSON response for documents read as raw dicts, encoded with orjson and never validated again."""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+async def raw_ndjson_lines(cursor) -> AsyncIterator[bytes]:
+    async for document in cursor:
+        yield dumps(document) + b"\n"
@@ -0,0 +1,83 @@
+"""
+Offline index management, run ahead of a deploy so workers can boot with DEI0_SYNC_INDEXES=false.
+
+ python -m server.indexes sync [--drop]   create the declared indexes (drop the undeclared ones with --drop)
+ python -m server.indexes check           list missing/undeclared indexes, exit code 1 if any is missing
+"""
+import argparse
+import asyncio
+import sys
+from typing import List, Tuple, Type
+
+from beanie import Document
+from beanie.odm.fields import IndexModelField
+from beanie.odm.utils.pydantic import get_field_type
+from pymongo import IndexModel
+
+from . import db
+from .models import DOCUMENT_MODELS
+from .settings import get_settings
+
+
+def declared_indexes(model: Type[Document]) -> List[IndexModelField]:
+    # same sources as Beanie: Indexed(...) fields plus Settings.indexes
+    indexes = []
+    for name, field in model.model_fields.items():
+        indexed = getattr(get_field_type(field), "_indexed", None)
+        if indexed:
+            indexes.append(IndexModelField(IndexModel([(field.alias or name, indexed[0])], **indexed[1])))
+    return IndexModelField.merge_indexes(indexes, model.get_settings().indexes or [])
+
+
+def existing_indexes(index_information: dict) -> List[IndexModelField]:
+    # mongo reports a text index as _fts/_ftsx keys, its fields are the keys of weights
+    for details in index_information.values():
+        if ("_fts", "text") in details["key"]:
+            details["key"] = [(field, "text") for field in sorted(details["weights"])]
+    return IndexModelField.from_motor_index_information(index_information)
+
+
+async def compare_indexes(model: Type[Document]) -> Tuple[List[IndexModelField], List[IndexModelField]]:
+    existing = existing_indexes(await model.get_motor_collection().index_information())
+    declared = declared_indexes(model)
+    missing = [index for index in declared if IndexModelField.find_index_with_the_same_fields(existing, index) is None]
+    undeclared = [index for index in existing if IndexModelField.find_index_with_the_same_fields(declared, index) is None]
+    return missing, undeclared
+
+
+async def check() -> int:
+    await db.connect(get_settings(), DOCUMENT_MODELS, sync_indexes=False)
+    missing_count = 0
+    for model in DOCUMENT_MODELS:
+        missing, undeclared = await compare_indexes(model)
+        missing_count += len(missing)
+        for index in missing:
+            print(f"{model.__name__}: missing index {index.name} {index.fields}")
+        for index in undeclared:
+            print(f"{model.__name__}: undeclared index {index.name} {index.fields}")
+    print("indexes ok" if not missing_count else f"{missing_count} missing indexes")
+    db.close()
+    return 1 if missing_count else 0
+
+
+async def sync(drop: bool) -> int:
+    await db.connect(get_settings(), DOCUMENT_MODELS, sync_indexes=True, allow_index_dropping=drop)
+    db.close()
+    return await check()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m server.indexes", description="dei0 index management")
+    commands = parser.add_subparsers(dest="command", required=True)
+    sync_parser = commands.add_parser("sync", help="create the declared indexes")
+    sync_parser.add_argument("--drop", action="store_true", help="drop the indexes that are not declared")
+    commands.add_parser("check", help="verify that every declared index exists")
+    args = parser.parse_args(argv)
+
+    if args.command == "sync":
+        return asyncio.run(sync(args.drop))
+    return asyncio.run(check())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
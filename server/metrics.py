@@ -0,0 +1,183 @@
+"""
+Prometheus metrics: HTTP requests by route template, MongoDB commands and pool checkouts, password hashing.
+
+Requests are labelled with the route template (/meals/recipes/{recipe_id}),
+never the raw path, so the number of series stays bounded. Mongo timings come
+from pymongo's monitoring listeners registered on the client.
+
+With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR to an empty
+directory: every worker writes its samples there and /metrics merges them.
+"""
+import os
+import threading
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+from pymongo import monitoring
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# mongo answers in micro to milliseconds, requests in milliseconds to seconds
+MONGO_BUCKETS = (.0002, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+HTTP_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP requests by route template and status code",
+    ("method", "route", "status"), buckets=HTTP_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests being served", multiprocess_mode="livesum",
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds", "MongoDB commands by collection, command and outcome",
+    ("collection", "command", "outcome"), buckets=MONGO_BUCKETS,
+)
+MONGO_CHECKOUT_WAIT = Histogram(
+    "mongodb_pool_checkout_wait_seconds", "Time waited for a pooled connection", buckets=MONGO_BUCKETS,
+)
+MONGO_CHECKOUT_FAILURES = Counter(
+    "mongodb_pool_checkout_failures_total", "Connection checkouts that failed", ("reason",),
+)
+MONGO_CONNECTIONS = Gauge(
+    "mongodb_pool_connections", "Open pooled connections", multiprocess_mode="livesum",
+)
+
+# bcrypt takes tens of milliseconds per call, the wait depends on the logins in flight
+PASSWORD_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+PASSWORD_HASH_QUEUE_WAIT = Histogram(
+    "password_hash_queue_wait_seconds", "Time a bcrypt call waited for a free hashing thread", ("operation",),
+    buckets=PASSWORD_BUCKETS,
+)
+PASSWORD_HASH_DURATION = Histogram(
+    "password_hash_duration_seconds", "Duration of bcrypt hash and verify calls", ("operation",),
+    buckets=PASSWORD_BUCKETS,
+)
+
+ADMISSION_QUEUE_WAIT = Histogram(
+    "admission_queue_wait_seconds", "Time requests waited to be admitted, by admission class", ("admission_class",),
+    buckets=HTTP_BUCKETS,
+)
+ADMISSION_REJECTIONS = Counter(
+    "admission_rejections_total", "Requests answered 503 by admission control", ("admission_class", "reason"),
+)
+
+UNMATCHED_ROUTE = "unmatched"
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, the route template is the one FastAPI matched for the request."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        REQUESTS_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_PROGRESS.dec()
+            route = scope.get("route")
+            template = getattr(route, "path_format", None) or UNMATCHED_ROUTE
+            REQUEST_DURATION.labels(scope["method"], template, str(status)).observe(time.perf_counter() - started)
+
+
+def metrics_endpoint(request: Request) -> Response:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def mark_process_dead(pid: int):
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Duration of every command; the collection is only known from the started event."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        target = event.command.get(event.command_name)
+        if not isinstance(target, str):
+            # getMore carries the cursor id, its collection is a separate field
+            target = event.command.get("collection")
+        self._collections[event.request_id] = target if isinstance(target, str) else ""
+
+    def _observe(self, event, outcome: str):
+        collection = self._collections.pop(event.request_id, "")
+        MONGO_COMMAND_DURATION.labels(collection, event.command_name, outcome).observe(event.duration_micros / 1e6)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._observe(event, "succeeded")
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._observe(event, "failed")
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Checkout waits (timed per thread, a checkout runs on one thread) and open connections."""
+
+    def __init__(self):
+        self._checkout = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._checkout.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._checkout, "started", None)
+        if started is not None:
+            MONGO_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+            self._checkout.started = None
+
+    def connection_check_out_failed(self, event):
+        self._checkout.started = None
+        MONGO_CHECKOUT_FAILURES.labels(event.reason).inc()
+
+    def connection_created(self, event):
+        MONGO_CONNECTIONS.inc()
+
+    def connection_closed(self, event):
+        MONGO_CONNECTIONS.dec()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def mongo_listeners():
+    return [CommandMetrics(), PoolMetrics()]
@@ -1,13 +1,19 @@
-from beanie import Document, Indexed
+from beanie import Document, Indexed, before_event, Insert, Replace, Save, SaveChanges
 from pydantic.fields import Field
-from pydantic import BaseModel, EmailStr, PositiveInt, computed_field
+from pydantic import BaseModel, EmailStr, PositiveInt, field_serializer
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
+from uuid import UUID
 from pydantic_extra_types.phone_numbers import PhoneNumber
 from fastapi_users.db import BeanieBaseUser, BeanieUserDatabase
 from fastapi_users import schemas
 from beanie import PydanticObjectId
+from pymongo import ASCENDING, TEXT, IndexModel
+from .nutrition import NUTRIENT_FIELDS, hundreds, weighted_totals
+from .search import name_key
+from .allergens import types_mask
+from .db import RoutedReads
 
 
 class IngredientType(str,Enum): 
@@ -15,11 +21,40 @@ class IngredientType(str,Enum):
     FAT = 'fat'  
     SODIUM = 'sodium'  
     SUGAR = 'sugar'  
+    MEAT = 'meat'  
+    FISH = 'fish'  
+    EGGS = 'eggs'  
+    CHEESE = 'cheese'  
+    LACTOSE = 'lactose'  
+    CAFFEINE = 'caffeine'  
+    NUTS = 'nuts'  
     OTHER = 'other'  
 
-class Ingredient(Document):  
+class Nutrients(BaseModel):  
+    kcal: float = 0
+    protein: float = 0
+    fat: float = 0
+    carbs: float = 0
+    sodium: float = 0
+    sugar: float = 0
+
+    def to_vector(self) -> List[float]:
+        return [getattr(self, field) for field in NUTRIENT_FIELDS]
+
+
+class Ingredient(RoutedReads, Document):  
     name: Indexed(str)
     aliment_types: List[IngredientType]
+    nutrients: Optional[Nutrients] = None  # per 100 gr or 100 ml
+    unit_weight: Optional[float] = None  # gr or ml of one 'unit'
+    name_key: Optional[str] = None  # name lowercased without accents, for prefix search
+
+    class Settings:
+        indexes = [IndexModel([("name_key", ASCENDING)], name="name_key")]
+
+    @before_event(Insert, Replace, Save)
+    def set_name_key(self):
+        self.name_key = name_key(self.name)
 
 
 class MeasureUnit(str,Enum): 
@@ -34,10 +69,57 @@ class IngredientInRecipe(BaseModel):
     measure_unit: MeasureUnit
 
 
-class Recipe(Document):  
+class StoredRevision(BaseModel):
+    """Document mixin, revision_id is sent as stored: the one of the ETag, which If-Match takes back."""
+
+    @field_serializer("revision_id", check_fields=False)
+    def stored_revision_id(self, revision_id: Optional[UUID]) -> Optional[UUID]:
+        # beanie gives loaded documents a fresh revision_id for their next save and keeps the stored one aside
+        return self._previous_revision_id
+
+
+class Recipe(RoutedReads, StoredRevision, Document):  
     name: Indexed(str,unique=True)
     ingredients: List[IngredientInRecipe]
     preparation: str
+    nutrition: Optional[Nutrients] = None  # totals of the recipe, kept in sync on writes
+    name_key: Optional[str] = None  # name lowercased without accents, for prefix search
+    allergen_mask: int = 0  # bits of the ingredient types in the recipe, see allergens.py
+
+    class Settings:
+        use_revision = True
+        indexes = [
+            # recipes embedding an ingredient, refreshed when the ingredient changes
+            IndexModel([("ingredients.ingredient._id", ASCENDING)], name="ingredients_ingredient_id"),
+            IndexModel([("name_key", ASCENDING)], name="name_key"),
+            # $bitsAllClear is checked on the index keys, rejected recipes are never fetched
+            IndexModel([("allergen_mask", ASCENDING)], name="allergen_mask"),
+            # spanish stemming and stop words, text indexes already ignore case and accents
+            IndexModel([("name", TEXT), ("preparation", TEXT)], name="recipe_text",
+                       default_language="spanish", weights={"name": 5, "preparation": 1}),
+        ]
+
+    @before_event(Insert, Replace, Save)
+    def compute_nutrition(self):
+        self.nutrition = recipe_nutrition(self.ingredients)
+
+    @before_event(Insert, Replace, Save)
+    def compute_allergen_mask(self):
+        self.allergen_mask = recipe_allergen_mask(self.ingredients)
+
+    @before_event(Insert, Replace, Save)
+    def set_name_key(self):
+        self.name_key = name_key(self.name)
+
+
+def recipe_nutrition(ingredients: List[IngredientInRecipe]) -> Nutrients:
+    factors = [hundreds(item.quantity, item.measure_unit.value, item.ingredient.unit_weight) for item in ingredients]
+    vectors = [item.ingredient.nutrients.to_vector() if item.ingredient.nutrients else None for item in ingredients]
+    return Nutrients(**weighted_totals(factors, vectors))
+
+def recipe_allergen_mask(ingredients: List[IngredientInRecipe]) -> int:
+    return types_mask(aliment_type.value for item in ingredients for aliment_type in item.ingredient.aliment_types)
+
 async def get_recipe_by_name(name: str) -> Recipe:
               recipe = await Recipe.find_one(Recipe.name == name)
               if recipe is None:
@@ -82,18 +164,51 @@ def foods_dict_to_list(foods_dict: dict) -> List[FoodInMealPlan]:
             measure_unit=food['measure_unit'],
             recipe_name=food['recipe_name'],
             kom=KindOfMeal(food['kom']),
-            dow=DayOfWeek(food['dow']) if food['dow'] is not None else None,
+            dow=DayOfWeek(food['dow']) if food.get('dow') is not None else None,
         )
         foods.append(food_model)
-    return food
+    return foods
 
-class MealPlan(Document):  
+class MealPlan(RoutedReads, StoredRevision, Document):  
     name: Indexed(str, unique=True)
     foods: Optional[List[FoodInMealPlan]]
     obser: str
     created_at: datetime = Field(default_factory=datetime.utcnow, auto_now_add=True)
     updated_at: datetime = Field(default_factory=datetime.utcnow, auto_now=True)
 
+    @before_event(Replace, Save, SaveChanges)
+    def touch_updated_at(self):
+        self.updated_at = datetime.utcnow()
+
+    class Settings:
+        use_revision = True
+        indexes = [
+            # plans using a recipe, on a given day: multikey over the foods array
+            IndexModel([("foods.recipe_name", ASCENDING), ("foods.dow", ASCENDING)], name="foods_recipe_name_dow"),
+        ]
+
+class MealPlanFoods(BaseModel):  
+    mealplan_id: PydanticObjectId
+    foods: List[FoodInMealPlan]
+    recipes: Optional[List[Recipe]] = None
+
+class RecipeNutrition(BaseModel):  
+    name: str
+    nutrition: Optional[Nutrients] = None
+
+class MealPlanNutrition(BaseModel):  
+    total: Nutrients
+    by_day: Dict[DayOfWeek, Nutrients] = {}
+
+class ShoppingListItem(BaseModel):  
+    ingredient: str
+    quantity: float
+    measure_unit: MeasureUnit
+
+class ShoppingList(BaseModel):  
+    mealplan_id: PydanticObjectId
+    items: List[ShoppingListItem]
+
 
 class USAStates(str,Enum): 
     AL = 'Alabama'  
@@ -165,13 +280,17 @@ class Gender(str,Enum):
     FAMALE = 'FAMELE'  
     NOBINARY = 'NOBINARY'  
 
-class User(BeanieBaseUser,Document):  
+class User(RoutedReads, BeanieBaseUser, Document):  
     name: str
     surname: str
     alias: Indexed(str, unique=True)
     role: UserRole
     created_at: datetime = Field(default_factory=datetime.utcnow, auto_now_add=True)
     updated_at: datetime = Field(default_factory=datetime.utcnow, auto_now=True)
+    @before_event(Replace, Save, SaveChanges)
+    def touch_updated_at(self):
+        self.updated_at = datetime.utcnow()
+
 async def get_user_by_name(name: str) -> User:
     user = await User.find_one(User.alias == name)
     if user is None:
@@ -244,9 +363,9 @@ class HabitsProfile(BaseModel):
     proteins_freq: int
 
 
-class UserProfile(Document):  
-    user_id: str
-    user_alias: str
+class UserProfile(RoutedReads, Document):  
+    user_id: Indexed(str, unique=True)  # one profile per user
+    user_alias: Indexed(str, unique=True)
     phone_number: PhoneNumber
     gender: Gender
     zipcode: PositiveInt
@@ -259,27 +378,24 @@ class UserProfile(Document):
     health_profile: Optional[HealthProfile] = None
     foods_profile: Optional[FoodsProfile] = None
     habits_profile: Optional[HabitsProfile] = None
+    bmi: Optional[float] = None  # kg/m2 whatever the metric unit, kept in sync on writes
     created_at: datetime = Field(default_factory=datetime.utcnow, auto_now_add=True)
     updated_at: datetime = Field(default_factory=datetime.utcnow, auto_now=True)
 
+    class Settings:
+        indexes = [
+            IndexModel([("bmi", ASCENDING)], name="bmi"),
+            # analytics filtered by state/gender, rollups are refreshed one (state, gender) group at a time
+            IndexModel([("state", ASCENDING), ("gender", ASCENDING), ("bmi", ASCENDING)], name="state_gender_bmi"),
+        ]
+
+    @before_event(Replace, Save, SaveChanges)
+    def touch_updated_at(self):
+        self.updated_at = datetime.utcnow()
 
-    @computed_field
-    @property
-    def bmi(self) -> float:
-        """
-        Calculate the BMI (Body Mass Index) based on user's weight and height.
-
-        Returns:
-        float: The calculated BMI value.
-        """
-        if self.metric_unit.muselected == 'IMPERIAL':
-            height_m = self.height * 0.0254  # Convert inches to meters
-            weight_kg = self.starting_weight * 0.453592  # Convert lbs to kg
-        else:
-            height_m = self.height / 100  # Convert cm to meters
-            weight_kg = self.starting_weight
-        bmi = weight_kg / (height_m ** 2)
-        return bmi
+    @before_event(Insert, Replace, Save)
+    def compute_bmi(self):
+        self.bmi = body_mass_index(self.metric_unit, self.height, self.starting_weight)
 
     def has_health_profile(self) -> bool:
         return self.health_profile is not None
@@ -288,4 +404,35 @@ class UserProfile(Document):
         return self.foods_profile is not None
 
     def has_habits_profile(self) -> bool:
-        return self.habits_profile is not None    
\ No newline at end of file
+        return self.habits_profile is not None
+
+
+INCH_IN_METERS = 0.0254
+POUND_IN_KG = 0.453592
+
+def body_mass_index(metric_unit: MUnitSelected, height: int, weight: int) -> float:
+    """
+    Calculate the BMI (Body Mass Index) from the height and weight in the user's metric unit.
+
+    Returns:
+    float: The BMI value, in kg/m2.
+    """
+    if metric_unit.muselected == MUnitOptions.IMPERIAL:
+        height_m = height * INCH_IN_METERS
+        weight_kg = weight * POUND_IN_KG
+    else:
+        height_m = height / 100  # cm
+        weight_kg = weight
+    return weight_kg / (height_m ** 2)
+
+# body_mass_index as an aggregation expression, for updates that only carry some of its inputs
+BMI_EXPRESSION = {"$let": {
+    "vars": {"imperial": {"$eq": ["$metric_unit.muselected", MUnitOptions.IMPERIAL.value]}},
+    "in": {"$divide": [
+        {"$cond": ["$$imperial", {"$multiply": ["$starting_weight", POUND_IN_KG]}, "$starting_weight"]},
+        {"$pow": [{"$cond": ["$$imperial", {"$multiply": ["$height", INCH_IN_METERS]}, {"$divide": ["$height", 100]}]}, 2]},
+    ]},
+}}
+
+
+DOCUMENT_MODELS = [Ingredient, Recipe, MealPlan, User, UserProfile]
@@ -0,0 +1,36 @@
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+
+# fixed layout of the nutrient vector, values per 100 gr (or 100 ml)
+NUTRIENT_FIELDS = ("kcal", "protein", "fat", "carbs", "sodium", "sugar")
+
+# how many 100 gr/ml are in one measure unit
+HUNDREDS_PER_UNIT = {
+    'gr': 0.01,
+    'kg': 10.0,
+    'lt': 10.0,
+}
+
+
+def hundreds(quantity: float, measure_unit: str, unit_weight: Optional[float] = None) -> float:
+    """
+    Normalize a quantity to multiples of 100 gr/ml.
+
+    A 'unit' quantity needs the ingredient unit_weight (gr or ml of one unit),
+    without it the ingredient does not add to the totals.
+    """
+    if measure_unit == 'unit':
+        return quantity * unit_weight / 100 if unit_weight else 0.0
+    return quantity * HUNDREDS_PER_UNIT[measure_unit]
+
+
+def nutrient_matrix(vectors: Iterable[Optional[Sequence[float]]]) -> np.ndarray:
+    rows = [vector if vector is not None else (0.0,) * len(NUTRIENT_FIELDS) for vector in vectors]
+    return np.array(rows, dtype=float).reshape(-1, len(NUTRIENT_FIELDS))
+
+
+def weighted_totals(factors: Sequence[float], vectors: Iterable[Optional[Sequence[float]]]) -> Dict[str, float]:
+    """Sum of the nutrient vectors scaled by their factors, as one matrix product."""
+    totals = np.asarray(factors, dtype=float) @ nutrient_matrix(vectors)
+    return dict(zip(NUTRIENT_FIELDS, totals.tolist()))
@@ -0,0 +1,167 @@
+from typing import Any, Dict, Optional, Tuple, Type
+
+from beanie import Document, PydanticObjectId
+from fastapi import HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+
+from .conditional import DocumentStamp, check_document_etag, document_stamp, etag_matches, is_versioned, make_etag
+from .conditional import missing_stamp_fields, not_modified, stamp_etag
+from .fastjson import RawJSONResponse, raw_ndjson_lines
+from .projection import projected_response, projection_model
+from .settings import get_settings
+
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+class PageParams:
+    """
+    Query parameters shared by every list endpoint.
+
+    limit: max number of documents in the page (no limit if omitted)
+    after: _id of the last document of the previous page (keyset cursor)
+    stream: send the documents as NDJSON, one per line, straight from the cursor
+    """
+    def __init__(
+        self,
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[PydanticObjectId] = None,
+        stream: bool = False,
+    ):
+        self.limit = limit
+        self.after = after
+        self.stream = stream
+
+
+async def ndjson_lines(query):
+    async for document in query:
+        yield document.model_dump_json(by_alias=True) + "\n"
+
+
+def page_query(model: Type[Document], page: PageParams, filters: Optional[Dict[str, Any]] = None):
+    conditions = [filters] if filters else []
+    if page.after:
+        conditions.append({"_id": {"$gt": page.after}})
+    return model.find(*conditions).sort("+_id")
+
+
+def uses_raw_reads(model: Type[Document]) -> bool:
+    # computed fields only exist on parsed models, those keep the validated path
+    return get_settings().raw_reads and not model.model_computed_fields
+
+
+def raw_page_cursor(model: Type[Document], page: PageParams, filters: Optional[Dict[str, Any]] = None,
+                    fields: Optional[Tuple[str, ...]] = None):
+    """Motor cursor over the same page as page_query, documents come back as dicts."""
+    query = page_query(model, page, filters)
+    # an empty projection would return every field, _id is always listed
+    projection = {"_id": 1, **dict.fromkeys(fields, 1)} if fields is not None else None
+    return model.get_motor_collection().find(query.get_filter_query(), projection).sort("_id", 1)
+
+
+async def read_raw_page(cursor, page: PageParams, headers: dict) -> list:
+    if page.limit is None:
+        return await cursor.to_list(None)
+    documents = await cursor.limit(page.limit + 1).to_list(None)
+    if len(documents) > page.limit:
+        documents = documents[:page.limit]
+        headers[NEXT_CURSOR_HEADER] = str(documents[-1]["_id"])
+    return documents
+
+
+async def read_page(query, page: PageParams, headers: dict) -> list:
+    if page.limit is None:
+        return await query.to_list()
+    # one extra document tells if there is a next page without a count query
+    documents = await query.limit(page.limit + 1).to_list()
+    if len(documents) > page.limit:
+        documents = documents[:page.limit]
+        headers[NEXT_CURSOR_HEADER] = str(documents[-1].id)
+    return documents
+
+
+async def get_document(model: Type[Document], document_id: PydanticObjectId, response: Response,
+                       fields: Optional[Tuple[str, ...]], if_none_match: Optional[str], not_found_detail: str):
+    """
+    Return one versioned document by _id, with its ETag.
+
+    With If-None-Match only the _id/revision_id/updated_at stamp is read
+    first, a 304 never reads the document. Otherwise the document is read
+    once and the ETag is computed from what was read.
+    """
+    if if_none_match:
+        _, unchanged = await check_document_etag(model, document_id, fields, if_none_match, not_found_detail)
+        if unchanged:
+            return unchanged
+    if fields is None:
+        document = await model.get(document_id)
+        if document is None:
+            raise HTTPException(status_code=404, detail=not_found_detail)
+        response.headers["ETag"] = stamp_etag(document_stamp(document))
+        return document
+    extra = missing_stamp_fields(model, fields)
+    document = await model.find_one({"_id": document_id}).project(projection_model(model, fields + extra))
+    if document is None:
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    return projected_response(document, {"ETag": stamp_etag(document_stamp(document), fields)}, set(extra))
+
+
+async def list_documents(model: Type[Document], page: PageParams, response: Response,
+                         fields: Optional[Tuple[str, ...]] = None, if_none_match: Optional[str] = None,
+                         filters: Optional[Dict[str, Any]] = None):
+    """
+    Return one page of documents ordered by _id, only those matching filters when given.
+
+    When the page is full the _id to pass as `after` for the next page is sent
+    in the X-Next-Cursor header. In stream mode the body is NDJSON and the
+    cursor is the _id of the last line. With fields only _id and those fields
+    are read from Mongo. Pages of versioned documents carry an ETag computed
+    from the _id/revision_id/updated_at of the documents returned; with
+    If-None-Match those are first read alone, so a 304 never reads the
+    documents.
+
+    With the raw_reads setting the documents are sent as Motor returns them,
+    encoded with orjson, without building models nor validating the response.
+    """
+    versioned = is_versioned(model) and not page.stream
+    # a projected page also reads what its ETag is computed from, dropped from the body
+    extra = missing_stamp_fields(model, fields) if versioned and fields is not None else ()
+    read_fields = fields + extra if fields is not None else None
+
+    raw = uses_raw_reads(model)
+    if raw:
+        query = raw_page_cursor(model, page, filters, read_fields)
+    else:
+        query = page_query(model, page, filters)
+        if read_fields is not None:
+            query = query.project(projection_model(model, read_fields))
+
+    if page.stream:
+        if page.limit is not None:
+            query = query.limit(page.limit)
+        lines = raw_ndjson_lines(query) if raw else ndjson_lines(query)
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+
+    if versioned and if_none_match:
+        stamps = await read_page(page_query(model, page, filters).project(DocumentStamp), page, {})
+        etag = make_etag(stamps, fields)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+
+    headers = {}
+    if raw:
+        documents = await read_raw_page(query, page, headers)
+    else:
+        documents = await read_page(query, page, headers)
+    if versioned:
+        headers["ETag"] = make_etag(map(document_stamp, documents), fields)
+
+    if raw:
+        for document in documents:
+            for name in extra:
+                document.pop(name, None)
+        return RawJSONResponse(documents, headers=headers)
+    if fields is not None:
+        return projected_response(documents, headers, set(extra))
+    response.headers.update(headers)
+    return documents
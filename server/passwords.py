@@ -0,0 +1,55 @@
+"""
+bcrypt hashing and verification on a bounded thread pool, off the event loop.
+
+A bcrypt call takes tens of milliseconds of CPU; run on the event loop it
+stalls every request of the worker. The bcrypt library releases the GIL while
+hashing, so threads run the calls in parallel with the loop. At most
+DEI0_PASSWORD_HASH_WORKERS calls run at once, the others wait their turn (the
+wait is exported as a metric).
+
+The cost factor is DEI0_BCRYPT_ROUNDS: hashes made with another cost are
+rehashed on the next successful login.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+
+from fastapi_users.password import PasswordHelper
+from passlib.context import CryptContext
+
+from .metrics import PASSWORD_HASH_DURATION, PASSWORD_HASH_QUEUE_WAIT
+from .settings import Settings
+
+
+class PasswordPool:
+    def __init__(self, workers: int, rounds: int):
+        self.workers = workers
+        self.helper = PasswordHelper(CryptContext(
+            schemes=["bcrypt"], deprecated="auto",
+            bcrypt__rounds=rounds, bcrypt__min_rounds=rounds, bcrypt__max_rounds=rounds,
+        ))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "PasswordPool":
+        return cls(settings.password_hash_workers, settings.bcrypt_rounds)
+
+    async def _run(self, operation: str, function: Callable[..., Any], *args: Any) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        queued = time.perf_counter()
+        async with self._slots:
+            started = time.perf_counter()
+            PASSWORD_HASH_QUEUE_WAIT.labels(operation).observe(started - queued)
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+            finally:
+                PASSWORD_HASH_DURATION.labels(operation).observe(time.perf_counter() - started)
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", self.helper.hash, password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        return await self._run("verify", self.helper.verify_and_update, plain_password, hashed_password)
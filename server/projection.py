@@ -0,0 +1,85 @@
+from enum import Enum
+from functools import lru_cache
+from typing import Any, Mapping, Optional, Tuple, Type
+
+from beanie import Document, PydanticObjectId
+from fastapi import HTTPException, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ConfigDict, Field, create_model
+
+from .models import Ingredient, Recipe, MealPlan, User, UserProfile
+
+
+class View(str, Enum):
+    SUMMARY = 'summary'
+
+
+# fields of every named view, _id is always returned
+VIEWS = {
+    View.SUMMARY: {
+        Ingredient: ("name",),
+        Recipe: ("name",),
+        MealPlan: ("name",),
+        User: ("alias", "name", "surname"),
+        UserProfile: ("user_id", "user_alias"),
+    },
+}
+
+HIDDEN_FIELDS = ("id", "revision_id")
+
+
+class ProjectionParams:
+    """
+    fields: comma separated list of the fields to return
+    view: named set of fields (summary)
+    """
+    def __init__(
+        self,
+        fields: Optional[str] = Query(None, description="comma separated list of fields"),
+        view: Optional[View] = None,
+    ):
+        self.fields = fields
+        self.view = view
+
+    def resolve(self, model: Type[Document]) -> Optional[Tuple[str, ...]]:
+        """Fields to project, None for the whole document and () when only _id was asked for."""
+        if self.view is not None:
+            return VIEWS[self.view][model]
+        if not self.fields:
+            return None
+        names = {name.strip() for name in self.fields.split(",")} - {"", "_id", *HIDDEN_FIELDS}
+        unknown = sorted(name for name in names if name not in model.model_fields)
+        if unknown:
+            raise HTTPException(status_code=400, detail="unknown fields: " + ", ".join(unknown))
+        return tuple(sorted(names))
+
+
+@lru_cache(maxsize=None)
+def projection_model(model: Type[Document], fields: Tuple[str, ...]) -> Type[BaseModel]:
+    """Lightweight model with only _id and the given fields, Beanie turns it into the Mongo projection."""
+    definitions = {name: (Optional[model.model_fields[name].annotation], None) for name in fields}
+    return create_model(
+        f"{model.__name__}Projection",
+        __config__=ConfigDict(populate_by_name=True),
+        id=(Optional[PydanticObjectId], Field(None, alias="_id")),
+        **definitions,
+    )
+
+
+def projected_response(content: Any, headers: Optional[dict] = None, exclude: Optional[set] = None) -> JSONResponse:
+    # projected documents do not match the full response_model, so they skip it
+    return JSONResponse(content=jsonable_encoder(content, exclude=exclude), headers=headers)
+
+
+async def find_projected(model: Type[Document], query: Mapping[str, Any], fields: Tuple[str, ...],
+                         not_found_detail: str, headers: Optional[dict] = None) -> JSONResponse:
+    document = await model.find_one(query).project(projection_model(model, fields))
+    if document is None:
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    return projected_response(document, headers)
+
+
+async def get_projected(model: Type[Document], document_id: PydanticObjectId, fields: Tuple[str, ...],
+                        not_found_detail: str, headers: Optional[dict] = None) -> JSONResponse:
+    return await find_projected(model, {"_id": document_id}, fields, not_found_detail, headers)
@@ -0,0 +1,255 @@
+"""
+Query-plan inspector for development and staging (DEI0_QUERY_PLANS=true).
+
+A pymongo command listener sees every query the app sends (Beanie, fastapi-users
+or raw Motor), reduces it to its shape (filter/sort/projection keys and operators,
+values dropped) and explains each new shape once, in the background, with
+executionStats. Shapes whose plan has a COLLSCAN or examines many more documents
+than it returns are flagged, with the routes that issued them.
+
+ GET /query-plans[?flagged=true]                          the report
+ python -m server.queryplans report --url URL [--check]   print it, --check exits 1 when a shape is flagged
+"""
+import argparse
+import asyncio
+import json
+import sys
+import threading
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from pymongo import monitoring
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+EXPLAINED_COMMANDS = ("find", "aggregate", "count", "distinct", "findAndModify", "update", "delete")
+SKIPPED_DATABASES = ("admin", "config", "local")
+# session, transaction and routing fields, explain takes the bare command
+SESSION_FIELDS = ("lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern")
+WRITE_STAGES = ("$out", "$merge")
+MAX_SHAPES = 1000
+NO_ROUTE = "-"
+
+current_scope: ContextVar[Optional[Scope]] = ContextVar("current_scope", default=None)
+
+
+class RouteContextMiddleware:
+    """Keeps the request scope in a ContextVar, the router fills in the matched route before the queries run."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = current_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_scope.reset(token)
+
+
+def current_route() -> str:
+    scope = current_scope.get()
+    route = scope.get("route") if scope else None
+    if route is None:
+        return NO_ROUTE
+    return f"{scope['method']} {route.path_format}"
+
+
+def shape_of(value: Any) -> Any:
+    # operators and field names stay, values become their type
+    if isinstance(value, dict):
+        return {key: shape_of(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = [shape_of(item) for item in value]
+        return shapes if any(isinstance(item, (dict, list)) for item in shapes) else "[...]"
+    return type(value).__name__
+
+
+def query_shape(command_name: str, command: Dict[str, Any]) -> Dict[str, Any]:
+    shape = {"command": command_name, "collection": command.get(command_name)}
+    if command_name == "aggregate":
+        shape["pipeline"] = shape_of(command.get("pipeline", []))
+    elif command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes", [])
+        shape["filter"] = shape_of(statements[0].get("q", {})) if statements else {}
+    else:
+        shape["filter"] = shape_of(command.get("filter", command.get("query", {})))
+    for key in ("sort", "projection", "key"):
+        if key in command:
+            shape[key] = shape_of(command[key])
+    return shape
+
+
+def explainable(command: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in command.items() if not key.startswith("$") and key not in SESSION_FIELDS}
+
+
+def walk(document: Any):
+    if isinstance(document, dict):
+        yield document
+        for value in document.values():
+            yield from walk(value)
+    elif isinstance(document, list):
+        for value in document:
+            yield from walk(value)
+
+
+def summarize_explain(explain: Dict[str, Any]) -> Dict[str, Any]:
+    # find, aggregate and write explains nest their plans differently, every plan node has a stage
+    stages = sorted({node["stage"] for node in walk(explain) if isinstance(node.get("stage"), str)})
+    docs_examined = keys_examined = returned = 0
+    for node in walk(explain):
+        if "totalDocsExamined" in node and "nReturned" in node:
+            docs_examined += node["totalDocsExamined"]
+            keys_examined += node.get("totalKeysExamined", 0)
+            returned += node["nReturned"]
+    return {"stages": stages, "docs_examined": docs_examined, "keys_examined": keys_examined, "returned": returned}
+
+
+class QueryPlanInspector:
+    def __init__(self, max_ratio: float = 10.0, min_docs_examined: int = 100):
+        self.max_ratio = max_ratio
+        self.min_docs_examined = min_docs_examined
+        self.shapes: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._client = None
+        self.listener = CommandCapture(self)
+
+    def start(self, client, max_ratio: Optional[float] = None, min_docs_examined: Optional[int] = None):
+        if max_ratio is not None:
+            self.max_ratio = max_ratio
+        if min_docs_examined is not None:
+            self.min_docs_examined = min_docs_examined
+        self._client = client
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._explain_new_shapes())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._task = self._loop = self._queue = None
+
+    def capture(self, event: monitoring.CommandStartedEvent):
+        """Runs in the pymongo thread: record the route, queue the first query of every shape."""
+        command = event.command
+        if event.command_name == "aggregate" and any(set(stage) & set(WRITE_STAGES) for stage in command.get("pipeline", [])):
+            return
+        shape = query_shape(event.command_name, command)
+        key = json.dumps(shape, sort_keys=True, default=str)
+        route = current_route()
+        with self._lock:
+            entry = self.shapes.get(key)
+            if entry is not None:
+                entry["count"] += 1
+                entry["routes"].add(route)
+                return
+            if len(self.shapes) >= MAX_SHAPES:
+                return
+            self.shapes[key] = {"shape": shape, "database": event.database_name, "count": 1, "routes": {route},
+                                "plan": None, "flags": [], "error": None}
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, (key, event.database_name, explainable(command)))
+
+    async def _explain_new_shapes(self):
+        while True:
+            key, database, command = await self._queue.get()
+            try:
+                explain = await self._client[database].command({"explain": command, "verbosity": "executionStats"})
+                plan = summarize_explain(explain)
+                flags = self.flags(plan)
+                error = None
+            except Exception as exception:  # a failed explain is reported, the inspector keeps going
+                plan, flags, error = None, [], str(exception)
+            with self._lock:
+                self.shapes[key].update(plan=plan, flags=flags, error=error)
+            self._queue.task_done()
+
+    async def explained(self):
+        """Waits until every shape captured so far has its plan."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    def flags(self, plan: Dict[str, Any]) -> List[str]:
+        flags = []
+        if "COLLSCAN" in plan["stages"]:
+            flags.append("COLLSCAN")
+        examined, returned = plan["docs_examined"], plan["returned"]
+        if examined >= self.min_docs_examined and examined > self.max_ratio * max(returned, 1):
+            flags.append(f"examined {examined} documents to return {returned}")
+        return flags
+
+    def report(self, flagged_only: bool = False) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = [{**entry, "routes": sorted(entry["routes"])} for entry in self.shapes.values()]
+        if flagged_only:
+            entries = [entry for entry in entries if entry["flags"]]
+        return sorted(entries, key=lambda entry: (not entry["flags"], -entry["count"]))
+
+    def clear(self):
+        with self._lock:
+            self.shapes.clear()
+
+
+class CommandCapture(monitoring.CommandListener):
+    def __init__(self, inspector: QueryPlanInspector):
+        self.inspector = inspector
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name in EXPLAINED_COMMANDS and event.database_name not in SKIPPED_DATABASES:
+            self.inspector.capture(event)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+inspector = QueryPlanInspector()
+
+
+def query_plans_endpoint(request: Request) -> JSONResponse:
+    flagged_only = request.query_params.get("flagged", "").lower() in ("1", "true")
+    return JSONResponse(inspector.report(flagged_only))
+
+
+def print_report(entries: List[Dict[str, Any]]):
+    for entry in entries:
+        status = "; ".join(entry["flags"]) or ("explain failed: " + entry["error"] if entry["error"] else "ok")
+        if entry["plan"] is None and not entry["error"]:
+            status = "not explained yet"
+        print(f"[{status}] {entry['count']}x {json.dumps(entry['shape'], sort_keys=True)}")
+        if entry["plan"]:
+            plan = entry["plan"]
+            print(f"    stages {','.join(plan['stages'])}  docs {plan['docs_examined']}  keys {plan['keys_examined']}"
+                  f"  returned {plan['returned']}")
+        print(f"    routes {', '.join(entry['routes'])}")
+
+
+def main(argv=None) -> int:
+    import httpx
+
+    parser = argparse.ArgumentParser(prog="python -m server.queryplans", description="dei0 query-plan report")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report_parser = commands.add_parser("report", help="print the query-plan report of a running server")
+    report_parser.add_argument("--url", default="http://localhost:8000")
+    report_parser.add_argument("--check", action="store_true", help="exit code 1 when a shape is flagged")
+    args = parser.parse_args(argv)
+
+    entries = httpx.get(args.url.rstrip("/") + "/query-plans").json()
+    print_report(entries)
+    flagged = [entry for entry in entries if entry["flags"]]
+    print(f"{len(entries)} query shapes, {len(flagged)} flagged")
+    return 1 if args.check and flagged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
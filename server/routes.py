@@ -1,9 +1,29 @@
-from typing import List,Any,Dict
-
-from beanie import PydanticObjectId
-from fastapi import APIRouter, HTTPException, Depends
+from typing import List,Any,Dict,Optional
+from uuid import uuid4
+
+from beanie import PydanticObjectId, UpdateResponse
+from beanie.odm.utils.dump import get_dict
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
 from .models import Ingredient, Recipe, MealPlan, FoodInMealPlan, StatusModel, Statuses, User, UserProfile
-from .models import get_recipe_by_name, foods_dict_to_list, get_user_by_name
+from .models import Nutrients, MealPlanNutrition, RecipeNutrition, recipe_allergen_mask, recipe_nutrition
+from .models import DayOfWeek, KindOfMeal, MealPlanFoods, MeasureUnit, ShoppingList, ShoppingListItem
+from .models import BMI_EXPRESSION, Gender, USAStates
+from .pagination import PageParams, get_document, list_documents
+from .projection import ProjectionParams, find_projected, get_projected, projection_model
+from .conditional import stored_revision_etag
+from .users import current_active_user, user_cache
+from .updates import literal_set, replacement_fields, to_mongo, update_and_get, validate_partial
+from .bulk import BULK_CHUNK_SIZE, BulkReport, bulk_import, iter_request_items
+from .nutrition import weighted_totals
+from .allergens import avoided_mask
+from .search import MAX_SEARCH_RESULTS, SearchHit, name_key, prefix_search, text_search
+from .changes import FeedCollection, change_feed, event_stream
+from .analytics import AnalyticsDimension, AnalyticsSource, ProfileGroupStats, mark_stale, may_change_group, profile_stats
 
 
 ingredients_router= APIRouter()
@@ -11,6 +31,8 @@ recipes_router= APIRouter()
 mealplans_router= APIRouter()
 users_router= APIRouter()
 userprofiles_router= APIRouter()
+analytics_router= APIRouter()
+changes_router= APIRouter()
 
 
 #######################################
@@ -22,18 +44,49 @@ async def get_ingredient(ingredient_id: PydanticObjectId) -> Ingredient:
         raise HTTPException(status_code=404, detail="ingredient not found")
     return ingredient
 
+async def refresh_recipes_with(ingredients: List[Ingredient]):
+    # recipes embed a copy of the ingredient, refresh it, their nutrition totals and allergens
+    by_id = {ingredient.id: ingredient for ingredient in ingredients}
+    operations = []
+    async for recipe in Recipe.find({"ingredients.ingredient._id": {"$in": list(by_id)}}):
+        for item in recipe.ingredients:
+            if item.ingredient.id in by_id:
+                item.ingredient = by_id[item.ingredient.id]
+        recipe.compute_nutrition()
+        recipe.compute_allergen_mask()
+        fields = get_dict(recipe, to_db=True)
+        update = {"ingredients": fields["ingredients"], "nutrition": fields["nutrition"],
+                  "allergen_mask": fields["allergen_mask"], "revision_id": uuid4()}
+        operations.append(UpdateOne({"_id": recipe.id}, {"$set": update}))
+        if len(operations) == BULK_CHUNK_SIZE:
+            await Recipe.get_motor_collection().bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await Recipe.get_motor_collection().bulk_write(operations, ordered=False)
+
+async def refresh_recipes_with_upserted(ingredient_ids: List[PydanticObjectId]):
+    # the bulk write only set fields, the recipes get the ingredients as stored
+    await refresh_recipes_with(await Ingredient.find({"_id": {"$in": ingredient_ids}}).to_list())
+
 
 
 
     
 #######  GET  ##########
+@ingredients_router.get("/ingredients/search", response_model=List[SearchHit])
+async def search_ingredients(q: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=MAX_SEARCH_RESULTS)):
+    return await prefix_search(Ingredient, q, limit)
+
 @ingredients_router.get("/ingredients/{ingredient_id}", response_model=Ingredient)
-async def get_ingredient_by_id(ingredient: Ingredient = Depends(get_ingredient)):
-    return ingredient
+async def get_ingredient_by_id(ingredient_id: PydanticObjectId, projection: ProjectionParams = Depends()):
+    fields = projection.resolve(Ingredient)
+    if fields is not None:
+        return await get_projected(Ingredient, ingredient_id, fields, "ingredient not found")
+    return await get_ingredient(ingredient_id)
 
 @ingredients_router.get("/ingredients/", response_model=List[Ingredient])
-async def get_all_ingredients():
-    return await Ingredient.find_all().to_list()
+async def get_all_ingredients(response: Response, page: PageParams = Depends(), projection: ProjectionParams = Depends()):
+    return await list_documents(Ingredient, page, response, projection.resolve(Ingredient))
     
 #######  POST  ##########
 @ingredients_router.post("/ingredients/", response_model=Ingredient)
@@ -42,24 +95,32 @@ async def create_ingredient(ingredient: Ingredient):
     await ingredient.create()
     return ingredient
 
+@ingredients_router.post("/ingredients/bulk", response_model=BulkReport)
+async def create_ingredients_bulk(request: Request, upsert: bool = False):
+    return await bulk_import(Ingredient, iter_request_items(request), upsert=upsert,
+                             after_update=refresh_recipes_with_upserted)
+
 #######  PUT  ##########
 # Complete replace
 @ingredients_router.put("/ingredients/{ingredient_id}", response_model=Ingredient)
-async def update_ingredient(ingredient_data: Ingredient, ingredient: Ingredient = Depends(get_ingredient)):
-    fields_to_update = ingredient_data.dict()
-    fields_to_update.pop("_id",None)     
+async def update_ingredient(ingredient_id: PydanticObjectId, ingredient_data: Ingredient):
+    ingredient_data.set_name_key()
+    fields_to_update = to_mongo(Ingredient, replacement_fields(ingredient_data))
     
-    ingredient_updated = await ingredient.update({"$set": fields_to_update})
+    ingredient_updated = await update_and_get(Ingredient, ingredient_id, {"$set": fields_to_update}, "ingredient not found")
+    await refresh_recipes_with([ingredient_updated])
     return ingredient_updated
 
 # Partial replace
 @ingredients_router.put("/ingredients/{ingredient_id}/update", response_model=Ingredient)
 async def update_ingredient(ingredient_id: PydanticObjectId, ingredient_data: Dict[str, Any]):
-    ingredient = await Ingredient.get(ingredient_id)   
+    values = validate_partial(Ingredient, ingredient_data, readonly=("name_key",))
+    if values.get("name") is not None:
+        values["name_key"] = name_key(values["name"])
+    fields_to_update = to_mongo(Ingredient, values)
     
-    fields_to_update = ingredient_data
-    fields_to_update.pop("_id",None)     
-    await ingredient.update({"$set": fields_to_update})
+    ingredient = await update_and_get(Ingredient, ingredient_id, {"$set": fields_to_update}, "ingredient not found")
+    await refresh_recipes_with([ingredient])
     return ingredient
 
 
@@ -78,21 +139,40 @@ async def get_recipe(recipe_id: PydanticObjectId) -> Recipe:
         raise HTTPException(status_code=404, detail="recipe not found")
     return recipe
 
-async def check_recipe_exists(recipe_name: str) -> bool:
-    recipe = await get_recipe_by_name(recipe_name)
-    return not(recipe is None)
 
 
 
     
 #######  GET  ##########
+@recipes_router.get("/recipes/search", response_model=List[SearchHit])
+async def search_recipes(q: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=MAX_SEARCH_RESULTS),
+                         full_text: bool = False):
+    # full_text: words in name or preparation ranked by relevance, otherwise names starting with q
+    if full_text:
+        return await text_search(Recipe, q, limit)
+    return await prefix_search(Recipe, q, limit)
+
+@recipes_router.get("/recipes/compatible/{userprofile_id}", response_model=List[Recipe])
+async def get_compatible_recipes(userprofile_id: PydanticObjectId, response: Response, page: PageParams = Depends(),
+                  projection: ProjectionParams = Depends(), if_none_match: Optional[str] = Header(None)):
+    # recipes without any ingredient type the profile rules out
+    restrictions = projection_model(UserProfile, ("health_profile", "foods_profile"))
+    userprofile = await UserProfile.find_one({"_id": userprofile_id}).project(restrictions)
+    if userprofile is None:
+        raise HTTPException(status_code=404, detail="userprofile not found")
+    mask = avoided_mask(userprofile.health_profile, userprofile.foods_profile)
+    filters = {"allergen_mask": {"$bitsAllClear": mask}} if mask else None
+    return await list_documents(Recipe, page, response, projection.resolve(Recipe), if_none_match, filters)
+
 @recipes_router.get("/recipes/{recipe_id}", response_model=Recipe)
-async def get_recipe_by_id(recipe: Recipe = Depends(get_recipe)):
-    return recipe
+async def get_recipe_by_id(recipe_id: PydanticObjectId, response: Response, projection: ProjectionParams = Depends(),
+                  if_none_match: Optional[str] = Header(None)):
+    return await get_document(Recipe, recipe_id, response, projection.resolve(Recipe), if_none_match, "recipe not found")
 
 @recipes_router.get("/recipes/", response_model=List[Recipe])
-async def get_all_recipes():
-    return await Recipe.find_all().to_list()
+async def get_all_recipes(response: Response, page: PageParams = Depends(), projection: ProjectionParams = Depends(),
+                  if_none_match: Optional[str] = Header(None)):
+    return await list_documents(Recipe, page, response, projection.resolve(Recipe), if_none_match)
     
 #######  POST  ##########
 @recipes_router.post("/recipes/", response_model=Recipe)
@@ -101,25 +181,37 @@ async def create_recipe(recipe: Recipe):
     await recipe.create()
     return recipe
 
+@recipes_router.post("/recipes/bulk", response_model=BulkReport)
+async def create_recipes_bulk(request: Request, upsert: bool = False):
+    return await bulk_import(Recipe, iter_request_items(request), upsert=upsert)
+
 #######  PUT  ##########
 # Complete replace
 @recipes_router.put("/recipes/{recipe_id}", response_model=Recipe)
-async def update_recipe(recipe_data: Recipe, recipe: Recipe = Depends(get_recipe)):
-    fields_to_update = recipe_data.dict()
-    fields_to_update.pop("_id",None)     
+async def update_recipe(recipe_id: PydanticObjectId, recipe_data: Recipe, response: Response,
+                        if_match: Optional[str] = Header(None)):
+    recipe_data.compute_nutrition()
+    recipe_data.compute_allergen_mask()
+    recipe_data.set_name_key()
+    fields_to_update = to_mongo(Recipe, replacement_fields(recipe_data))
     
-    await recipe.update({"$set": {"ingredients": []}})
-    recipe_updated = await recipe.update({"$set": fields_to_update})
+    recipe_updated = await update_and_get(Recipe, recipe_id, {"$set": fields_to_update}, "recipe not found", if_match)
+    response.headers["ETag"] = stored_revision_etag(recipe_updated)
     return recipe_updated
 
 # Partial replace
 @recipes_router.put("/recipes/{recipe_id}/update", response_model=Recipe)
-async def update_recipe(recipe_id: PydanticObjectId, recipe_data: Dict[str, Any]):
-    recipe = await Recipe.get(recipe_id)   
+async def update_recipe(recipe_id: PydanticObjectId, recipe_data: Dict[str, Any], response: Response,
+                        if_match: Optional[str] = Header(None)):
+    values = validate_partial(Recipe, recipe_data, readonly=("nutrition", "name_key", "allergen_mask"))
+    if values.get("ingredients") is not None:
+        values["nutrition"] = recipe_nutrition(values["ingredients"])
+        values["allergen_mask"] = recipe_allergen_mask(values["ingredients"])
+    if values.get("name") is not None:
+        values["name_key"] = name_key(values["name"])
     
-    fields_to_update = recipe_data
-    fields_to_update.pop("_id",None)     
-    await recipe.update({"$set": fields_to_update})
+    recipe = await update_and_get(Recipe, recipe_id, {"$set": to_mongo(Recipe, values)}, "recipe not found", if_match)
+    response.headers["ETag"] = stored_revision_etag(recipe)
     return recipe
 
 
@@ -141,66 +233,173 @@ async def get_mealplan(mealplan_id: PydanticObjectId) -> MealPlan:
 
 
    
-async def check_recipes_ok(foods:List[FoodInMealPlan]) -> bool:
-    result = True
-    for foods_value in foods:
-        result = result and await check_recipe_exists(foods_value.recipe_name)
-    return result
+async def get_missing_recipes(foods: Optional[List[FoodInMealPlan]]) -> List[str]:
+    # one $in query over the unique name index, whatever the size of the plan
+    names = list(dict.fromkeys(food.recipe_name for food in foods or []))
+    if not names:
+        return []
+    found = set(await Recipe.distinct("name", {"name": {"$in": names}}))
+    return [name for name in names if name not in found]
+
+async def check_recipes_ok(foods: Optional[List[FoodInMealPlan]]):
+    missing = await get_missing_recipes(foods)
+    if missing:
+        raise HTTPException(status_code=404, detail="mealplan contains a recipe undefined: " + ", ".join(missing))
+
+async def reject_missing_recipes(mealplans: List[MealPlan]) -> Dict[int, str]:
+    # recipes of a whole bulk chunk are checked with a single query
+    missing = set(await get_missing_recipes([food for mealplan in mealplans for food in mealplan.foods or []]))
+    rejected = {}
+    for position, mealplan in enumerate(mealplans):
+        names = sorted({food.recipe_name for food in mealplan.foods or []} & missing)
+        if names:
+            rejected[position] = "mealplan contains a recipe undefined: " + ", ".join(names)
+    return rejected
     
 #######  GET  ##########
 @mealplans_router.get("/mealplans/{mealplan_id}", response_model=MealPlan)
-async def get_mealplan_by_id(mealplan: MealPlan = Depends(get_mealplan)):
-    return mealplan
+async def get_mealplan_by_id(mealplan_id: PydanticObjectId, response: Response, projection: ProjectionParams = Depends(),
+                  if_none_match: Optional[str] = Header(None)):
+    return await get_document(MealPlan, mealplan_id, response, projection.resolve(MealPlan), if_none_match, "mealplan not found")
 
 @mealplans_router.get("/mealplans/", response_model=List[MealPlan])
-async def get_all_mealplans():
-    return await MealPlan.find_all().to_list()
+async def get_all_mealplans(response: Response, page: PageParams = Depends(), projection: ProjectionParams = Depends(),
+                  if_none_match: Optional[str] = Header(None)):
+    return await list_documents(MealPlan, page, response, projection.resolve(MealPlan), if_none_match)
     
+@mealplans_router.get("/mealplans/{mealplan_id}/nutrition", response_model=MealPlanNutrition)
+async def get_mealplan_nutrition(mealplan: MealPlan = Depends(get_mealplan)):
+    # totals are read from the nutrition stored on every recipe, one query for the whole plan
+    foods = mealplan.foods or []
+    names = list({food.recipe_name for food in foods})
+    recipes = await Recipe.find({"name": {"$in": names}}).project(RecipeNutrition).to_list()
+    vectors = {recipe.name: recipe.nutrition.to_vector() if recipe.nutrition else None for recipe in recipes}
+
+    by_day = {}
+    for dow in {food.dow for food in foods if food.dow is not None}:
+        day_foods = [food for food in foods if food.dow == dow]
+        by_day[dow] = Nutrients(**weighted_totals([food.portion for food in day_foods],
+                                                  [vectors.get(food.recipe_name) for food in day_foods]))
+    total = Nutrients(**weighted_totals([food.portion for food in foods],
+                                        [vectors.get(food.recipe_name) for food in foods]))
+    return MealPlanNutrition(total=total, by_day=by_day)
+
+def mealplan_foods_pipeline(mealplan_id: PydanticObjectId, dow: Optional[DayOfWeek], kom: Optional[KindOfMeal],
+                            with_recipes: bool) -> List[Dict[str, Any]]:
+    # the foods are filtered in mongo, only the matching ones travel
+    conditions = [{"$eq": ["$$food." + name, value.value]} for name, value in (("dow", dow), ("kom", kom)) if value is not None]
+    pipeline = [
+        {"$match": {"_id": mealplan_id}},
+        {"$project": {"foods": {"$filter": {
+            "input": {"$ifNull": ["$foods", []]},
+            "as": "food",
+            "cond": {"$and": conditions},
+        }}}},
+    ]
+    if with_recipes:
+        pipeline.append({"$lookup": {
+            "from": Recipe.get_motor_collection().name,
+            "localField": "foods.recipe_name",
+            "foreignField": "name",
+            "as": "recipes",
+        }})
+    return pipeline
+
+@mealplans_router.get("/mealplans/{mealplan_id}/foods", response_model=MealPlanFoods)
+async def get_mealplan_foods(mealplan_id: PydanticObjectId, dow: Optional[DayOfWeek] = None, kom: Optional[KindOfMeal] = None,
+                             recipes: bool = False):
+    rows = await MealPlan.aggregate(mealplan_foods_pipeline(mealplan_id, dow, kom, recipes)).to_list()
+    if not rows:
+        raise HTTPException(status_code=404, detail="mealplan not found")
+    return MealPlanFoods(mealplan_id=mealplan_id, foods=rows[0]["foods"], recipes=rows[0].get("recipes"))
+
+def shopping_list_pipeline(mealplan_id: PydanticObjectId) -> List[Dict[str, Any]]:
+    # kg are summed as gr, the other units are summed as they are
+    is_kg = {"$eq": ["$recipe.ingredients.measure_unit", MeasureUnit.KG.value]}
+    return [
+        {"$match": {"_id": mealplan_id}},
+        {"$unwind": "$foods"},
+        {"$lookup": {
+            "from": Recipe.get_motor_collection().name,
+            "localField": "foods.recipe_name",
+            "foreignField": "name",
+            "as": "recipe",
+        }},
+        {"$unwind": "$recipe"},
+        {"$unwind": "$recipe.ingredients"},
+        {"$project": {
+            "ingredient": "$recipe.ingredients.ingredient.name",
+            "measure_unit": {"$cond": [is_kg, MeasureUnit.GR.value, "$recipe.ingredients.measure_unit"]},
+            "quantity": {"$multiply": [
+                "$foods.portion",
+                "$recipe.ingredients.quantity",
+                {"$cond": [is_kg, 1000, 1]},
+            ]},
+        }},
+        {"$group": {
+            "_id": {"ingredient": "$ingredient", "measure_unit": "$measure_unit"},
+            "quantity": {"$sum": "$quantity"},
+        }},
+        {"$sort": {"_id.ingredient": 1, "_id.measure_unit": 1}},
+    ]
+
+@mealplans_router.get("/mealplans/{mealplan_id}/shopping-list", response_model=ShoppingList)
+async def get_mealplan_shopping_list(mealplan_id: PydanticObjectId):
+    rows = await MealPlan.aggregate(shopping_list_pipeline(mealplan_id)).to_list()
+    if not rows and await MealPlan.find_one({"_id": mealplan_id}) is None:
+        raise HTTPException(status_code=404, detail="mealplan not found")
+    items = [ShoppingListItem(quantity=row["quantity"], **row["_id"]) for row in rows]
+    return ShoppingList(mealplan_id=mealplan_id, items=items)
+
 #######  POST  ##########
 @mealplans_router.post("/mealplans/", response_model=MealPlan)
 async def create_mealplan(mealplan: MealPlan):      
-    recipe_name_ok = await check_recipes_ok(mealplan.foods)
-    if not recipe_name_ok:
-        raise HTTPException(status_code=404, detail="mealplan contains a recipe undefined")
+    await check_recipes_ok(mealplan.foods)
     
     await mealplan.create()
     return mealplan
 
+@mealplans_router.post("/mealplans/bulk", response_model=BulkReport)
+async def create_mealplans_bulk(request: Request, upsert: bool = False):
+    return await bulk_import(MealPlan, iter_request_items(request), upsert=upsert, check=reject_missing_recipes)
+
 #######  PUT  ##########
 # Complete replace
 @mealplans_router.put("/mealplans/{mealplan_id}", response_model=MealPlan)
-async def update_mealplan(mealplan_data: MealPlan, mealplan: MealPlan = Depends(get_mealplan)):
-    fields_to_update = mealplan_data.dict()
-    fields_to_update.pop("_id",None)     
+async def update_mealplan(mealplan_id: PydanticObjectId, mealplan_data: MealPlan, response: Response,
+                          if_match: Optional[str] = Header(None)):
+    await check_recipes_ok(mealplan_data.foods)
+    fields_to_update = to_mongo(MealPlan, replacement_fields(mealplan_data))
     
-    await mealplan.update({"$set": {"foods": []}})
-    mealplan_updated = await mealplan.update({"$set": fields_to_update})
+    mealplan_updated = await update_and_get(MealPlan, mealplan_id, {"$set": fields_to_update}, "mealplan not found", if_match)
+    response.headers["ETag"] = stored_revision_etag(mealplan_updated)
     return mealplan_updated
 
 # Partial replace
 @mealplans_router.put("/mealplans/{mealplan_id}/update", response_model=MealPlan)
-async def update_mealplan(mealplan_id: PydanticObjectId, mealplan_data: Dict[str, Any]):
-    mealplan = await MealPlan.get(mealplan_id)      
-    if mealplan_data.get('foods') != None:
-        recipe_name_ok = await check_recipes_ok(foods_dict_to_list(mealplan_data.get('foods')))
-        if not recipe_name_ok:
-            raise HTTPException(status_code=404, detail="mealplan contains a recipe undefined")
+async def update_mealplan(mealplan_id: PydanticObjectId, mealplan_data: Dict[str, Any], response: Response,
+                          if_match: Optional[str] = Header(None)):
+    values = validate_partial(MealPlan, mealplan_data)
+    if values.get('foods') != None:
+        await check_recipes_ok(values['foods'])
     
-    fields_to_update = mealplan_data
-    fields_to_update.pop("_id",None)     
-    await mealplan.update({"$set": fields_to_update})
+    mealplan = await update_and_get(MealPlan, mealplan_id, {"$set": to_mongo(MealPlan, values)}, "mealplan not found", if_match)
+    response.headers["ETag"] = stored_revision_etag(mealplan)
     return mealplan
 
 #Put for add a meal to a plan
 @mealplans_router.put("/mealplans/{mealplan_id}/addmeal", response_model=MealPlan)
 async def add_mealplan(mealplan_id: PydanticObjectId, mealplan_data: Dict[str, Any]):
-    mealplan = await MealPlan.get(mealplan_id)
-    if mealplan_data.get('foods') != None:
-        recipe_name_ok = await check_recipes_ok(foods_dict_to_list(mealplan_data.get('foods')))
-        if not recipe_name_ok:
-            raise HTTPException(status_code=404, detail="meal plan contains a recipe undefined")
-    await mealplan.update({"$push": {"foods": {"$each": foods_dict_to_list(mealplan_data.get("foods"))}}})
-    return mealplan
+    values = validate_partial(MealPlan, {"foods": mealplan_data.get("foods") or []})
+    if not values['foods']:
+        # nothing to add, a write would only bump the revision and invalidate every cached copy
+        raise RequestValidationError([{"loc": ("body", "foods"), "msg": "at least one food is required",
+                                       "type": "value_error.empty"}])
+    await check_recipes_ok(values['foods'])
+    fields = to_mongo(MealPlan, values)
+
+    update = {"$push": {"foods": {"$each": fields.pop("foods")}}, "$set": fields}
+    return await update_and_get(MealPlan, mealplan_id, update, "mealplan not found")
 #######  DELETE  ##########
 @mealplans_router.delete("/mealplans/{mealplan_id}", response_model=StatusModel)
 async def delete_mealplan(mealplan: MealPlan = Depends(get_mealplan)):
@@ -216,24 +415,19 @@ async def get_user(user_id: PydanticObjectId) -> User:
         raise HTTPException(status_code=404, detail="user not found")
     return user
 
-async def check_user_exists(user_name: str) -> bool:
-    user = await get_user_by_name(user_name)
-    return not(user is None)
-
-async def check_user_id_exists(user_id: str) -> bool:
-    user = await get_user(user_id)
-    return not(user is None)
 
 
     
 #######  GET  ##########
 @users_router.get("/users/{user_id}", response_model=User)
-async def get_user_by_id(user: User = Depends(get_user)):
-    return user
+async def get_user_by_id(user_id: PydanticObjectId, response: Response, projection: ProjectionParams = Depends(),
+                  if_none_match: Optional[str] = Header(None)):
+    return await get_document(User, user_id, response, projection.resolve(User), if_none_match, "user not found")
 
 @users_router.get("/users/", response_model=List[User])
-async def get_all_users():
-    return await User.find_all().to_list()
+async def get_all_users(response: Response, page: PageParams = Depends(), projection: ProjectionParams = Depends(),
+                  if_none_match: Optional[str] = Header(None)):
+    return await list_documents(User, page, response, projection.resolve(User), if_none_match)
     
 #######  POST  ##########
 @users_router.post("/users/", response_model=User)
@@ -245,21 +439,20 @@ async def create_user(user: User):
 #######  PUT  ##########
 # Complete replace
 @users_router.put("/users/{user_id}", response_model=User)
-async def update_user(user_data: User, user: User = Depends(get_user)):
-    fields_to_update = user_data.dict()
-    fields_to_update.pop("_id",None)     
+async def update_user(user_id: PydanticObjectId, user_data: User):
+    fields_to_update = to_mongo(User, replacement_fields(user_data))
     
-    user_updated = await user.update({"$set": fields_to_update})
+    user_updated = await update_and_get(User, user_id, {"$set": fields_to_update}, "user not found")
+    user_cache.invalidate_user(user_id)
     return user_updated
 
 # Partial replace
 @users_router.put("/users/{user_id}/update", response_model=User)
 async def update_user(user_id: PydanticObjectId, user_data: Dict[str, Any]):
-    user = await User.get(user_id)   
+    fields_to_update = to_mongo(User, validate_partial(User, user_data))
     
-    fields_to_update = user_data
-    fields_to_update.pop("_id",None)     
-    await user.update({"$set": fields_to_update})
+    user = await update_and_get(User, user_id, {"$set": fields_to_update}, "user not found")
+    user_cache.invalidate_user(user_id)
     return user
 
 
@@ -267,6 +460,7 @@ async def update_user(user_id: PydanticObjectId, user_data: Dict[str, Any]):
 @users_router.delete("/users/{user_id}", response_model=StatusModel)
 async def delete_user(user: User = Depends(get_user)):
     await user.delete()
+    user_cache.invalidate_user(user.id)
     return StatusModel(status=Statuses.DELETED)
 
 #######################################
@@ -278,73 +472,124 @@ async def get_userprofile(userprofile_id: PydanticObjectId) -> UserProfile:
         raise HTTPException(status_code=404, detail="userprofile not found")
     return userprofile
 
+async def find_userprofile(query: Dict[str, Any], projection: ProjectionParams) -> UserProfile:
+    fields = projection.resolve(UserProfile)
+    if fields is not None:
+        return await find_projected(UserProfile, query, fields, "userprofile not found")
+    userprofile = await UserProfile.find_one(query)
+    if userprofile is None:
+        raise HTTPException(status_code=404, detail="userprofile not found")
+    return userprofile
+
+async def check_profile_owner(user_id: str, user_alias: str) -> bool:
+    # alias and id must name the same user: one indexed point read, only _id comes back
+    try:
+        user_object_id = PydanticObjectId(user_id)
+    except InvalidId:
+        return False
+    user = await User.find_one({"_id": user_object_id, "alias": user_alias}).project(projection_model(User, ()))
+    return user is not None
 
-   
-async def check_user_alias_valid(user_alias_value:str) -> bool:
-    result = await check_user_exists(user_alias_value)
-    return result   
-async def check_user_id_valid(user_id_value:str) -> bool:
-    result = await check_user_id_exists(user_id_value)
-    return result
+# a profile never changes owner
+USERPROFILE_OWNER_FIELDS = ("user_alias", "user_id")
+# inputs of the stored bmi
+USERPROFILE_BMI_FIELDS = ("metric_unit", "height", "starting_weight")
 
     
 #######  GET  ##########
+@userprofiles_router.get("/userprofiles/by-user/{user_id}", response_model=UserProfile)
+async def get_userprofile_by_user(user_id: str, projection: ProjectionParams = Depends()):
+    return await find_userprofile({"user_id": user_id}, projection)
+
+@userprofiles_router.get("/userprofiles/by-alias/{user_alias}", response_model=UserProfile)
+async def get_userprofile_by_alias(user_alias: str, projection: ProjectionParams = Depends()):
+    return await find_userprofile({"user_alias": user_alias}, projection)
+
 @userprofiles_router.get("/userprofiles/{userprofile_id}", response_model=UserProfile)
-async def get_userprofile_by_id(userprofile: UserProfile = Depends(get_userprofile)):
-    return userprofile
+async def get_userprofile_by_id(userprofile_id: PydanticObjectId, response: Response, projection: ProjectionParams = Depends(),
+                  if_none_match: Optional[str] = Header(None)):
+    return await get_document(UserProfile, userprofile_id, response, projection.resolve(UserProfile), if_none_match, "userprofile not found")
 
 @userprofiles_router.get("/userprofiles/", response_model=List[UserProfile])
-async def get_all_userprofiles():
-    return await UserProfile.find_all().to_list()
+async def get_all_userprofiles(response: Response, page: PageParams = Depends(), projection: ProjectionParams = Depends(),
+                  if_none_match: Optional[str] = Header(None)):
+    return await list_documents(UserProfile, page, response, projection.resolve(UserProfile), if_none_match)
     
 #######  POST  ##########
 @userprofiles_router.post("/userprofiles/", response_model=UserProfile)
 async def create_userprofile(userprofile: UserProfile):   
        
-    user_alias_ok = await check_user_alias_valid(userprofile.user_alias)
-    if not user_alias_ok:
-        raise HTTPException(status_code=404, detail="userprofile contains a user_alias invalid")   
-    user_id_ok = await check_user_id_valid(userprofile.user_id)
-    if not user_id_ok:
-        raise HTTPException(status_code=404, detail="userprofile contains a user_id invalid")
-    await userprofile.create()
+    owner_ok = await check_profile_owner(userprofile.user_id, userprofile.user_alias)
+    if not owner_ok:
+        raise HTTPException(status_code=404, detail="userprofile contains a user_id/user_alias invalid")
+    try:
+        await userprofile.create()
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="user already has a userprofile")
+    await mark_stale(userprofile)
     return userprofile
 
 #######  PUT  ##########
+async def write_userprofile(userprofile_id: PydanticObjectId, values: Dict[str, Any], update) -> UserProfile:
+    if not may_change_group(values):
+        userprofile = await update_and_get(UserProfile, userprofile_id, update, "userprofile not found")
+        await mark_stale(userprofile, fields=values)
+        return userprofile
+    # the group the profile leaves is read by the write itself, a concurrent move cannot hide it
+    previous = await update_and_get(UserProfile, userprofile_id, update, "userprofile not found",
+                                    response_type=UpdateResponse.OLD_DOCUMENT)
+    userprofile = await get_userprofile(userprofile_id)
+    await mark_stale(previous, userprofile, fields=values)
+    return userprofile
+
 # Complete replace
 @userprofiles_router.put("/userprofiles/{userprofile_id}", response_model=UserProfile)
-async def update_userprofile(userprofile_data: UserProfile, userprofile: UserProfile = Depends(get_userprofile)):
-    fields_to_update = userprofile_data.dict()
-    fields_to_update.pop("_id",None)      
-    fields_to_update.pop("user_alias",None) 
-    fields_to_update.pop("user_id",None)
-    
-    userprofile_updated = await userprofile.update({"$set": fields_to_update})
-    return userprofile_updated
+async def update_userprofile(userprofile_id: PydanticObjectId, userprofile_data: UserProfile):
+    userprofile_data.compute_bmi()
+    values = replacement_fields(userprofile_data, readonly=USERPROFILE_OWNER_FIELDS)
+    fields_to_update = to_mongo(UserProfile, values)
+    return await write_userprofile(userprofile_id, values, {"$set": fields_to_update})
 
 # Partial replace
 @userprofiles_router.put("/userprofiles/{userprofile_id}/update", response_model=UserProfile)
 async def update_userprofile(userprofile_id: PydanticObjectId, userprofile_data: Dict[str, Any]):
-    userprofile = await UserProfile.get(userprofile_id)   
-       
-    if userprofile_data.get('user_alias') != None:
-        user_alias_ok = await check_user_alias_valid(userprofile.user_alias)
-        if not user_alias_ok:
-            raise HTTPException(status_code=404, detail="userprofile contains a user_alias invalid")   
-    if userprofile_data.get('user_id') != None:
-        user_id_ok = await check_user_id_valid(userprofile.user_id)
-        if not user_id_ok:
-            raise HTTPException(status_code=404, detail="userprofile contains a user_id invalid")
-    fields_to_update = userprofile_data
-    fields_to_update.pop("_id",None)      
-    fields_to_update.pop("user_alias",None) 
-    fields_to_update.pop("user_id",None)
-    await userprofile.update({"$set": fields_to_update})
-    return userprofile
+    values = validate_partial(UserProfile, userprofile_data, readonly=USERPROFILE_OWNER_FIELDS + ("bmi",))
+    fields_to_update = to_mongo(UserProfile, values)
+    update = {"$set": fields_to_update}
+    if set(values) & set(USERPROFILE_BMI_FIELDS):
+        # bmi also depends on the stored values of the fields not in the body, computed in the same write
+        update = [literal_set(fields_to_update), {"$set": {"bmi": BMI_EXPRESSION}}]
+    return await write_userprofile(userprofile_id, values, update)
 
 
 #######  DELETE  ##########
 @userprofiles_router.delete("/userprofiles/{userprofile_id}", response_model=StatusModel)
 async def delete_userprofile(userprofile: UserProfile = Depends(get_userprofile)):
     await userprofile.delete()
+    await mark_stale(userprofile)
     return StatusModel(status=Statuses.DELETED)
+
+
+#######################################
+######  ANALYTICS   ########
+#######################################
+@analytics_router.get("/analytics/userprofiles", response_model=List[ProfileGroupStats])
+async def get_userprofile_analytics(group_by: List[AnalyticsDimension] = Query([]), state: Optional[USAStates] = None,
+                  gender: Optional[Gender] = None, zipcode: Optional[int] = None,
+                  source: Optional[AnalyticsSource] = None):
+    # BMI distribution and habit frequencies of the matching profiles, one entry per group
+    return await profile_stats(group_by, state, gender, zipcode, source)
+
+
+#######################################
+######  CHANGES   ########
+#######################################
+@changes_router.get("/changes", response_class=StreamingResponse)
+async def get_changes(collections: List[FeedCollection] = Query(list(FeedCollection)), ids: List[PydanticObjectId] = Query([]),
+                  last_event_id: Optional[str] = Header(None), user: User = Depends(current_active_user)):
+    # Server-Sent Events of the meal plan and user profile changes, the user only gets the profiles it may read
+    if not change_feed.running:
+        raise HTTPException(status_code=503, detail="change feed is not enabled")
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    stream = event_stream(change_feed, user, set(collections), {str(id) for id in ids}, last_event_id)
+    return StreamingResponse(stream, media_type="text/event-stream", headers=headers)
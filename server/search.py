@@ -0,0 +1,86 @@
+"""
+Name search over the catalog (ingredients, recipes).
+
+Prefix search reads name_key, the name lowercased and without accents, with an
+anchored regex so Mongo walks the name_key index. Full text search over the
+recipes uses the recipe_text index (name and preparation).
+
+ python -m server.search backfill   fill name_key in the documents written before it existed
+"""
+import argparse
+import asyncio
+import re
+import sys
+import unicodedata
+from typing import List, Optional, Type
+
+from beanie import Document, PydanticObjectId
+from pydantic import BaseModel, Field
+from pymongo import UpdateOne
+
+MAX_SEARCH_RESULTS = 50
+
+
+def name_key(name: str) -> str:
+    # "Jamón Ibérico" -> "jamon iberico"
+    decomposed = unicodedata.normalize("NFKD", name)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).casefold().strip()
+
+
+class SearchHit(BaseModel):
+    id: PydanticObjectId = Field(alias="_id")
+    name: str
+    score: Optional[float] = None  # text search relevance
+
+
+async def prefix_search(model: Type[Document], text: str, limit: int) -> List[SearchHit]:
+    query = {"name_key": {"$regex": "^" + re.escape(name_key(text))}}
+    return await model.find(query).sort("+name_key").limit(limit).project(SearchHit).to_list()
+
+
+async def text_search(model: Type[Document], text: str, limit: int) -> List[SearchHit]:
+    pipeline = [
+        {"$match": {"$text": {"$search": text}}},
+        {"$sort": {"score": {"$meta": "textScore"}}},
+        {"$limit": limit},
+        {"$project": {"name": 1, "score": {"$meta": "textScore"}}},
+    ]
+    return await model.aggregate(pipeline, projection_model=SearchHit).to_list()
+
+
+async def backfill_name_keys(model: Type[Document], chunk_size: int = 500) -> int:
+    collection = model.get_motor_collection()
+    operations, updated = [], 0
+    async for document in collection.find({"name_key": {"$exists": False}}, {"name": 1}):
+        operations.append(UpdateOne({"_id": document["_id"]}, {"$set": {"name_key": name_key(document["name"])}}))
+        if len(operations) == chunk_size:
+            updated += (await collection.bulk_write(operations, ordered=False)).modified_count
+            operations = []
+    if operations:
+        updated += (await collection.bulk_write(operations, ordered=False)).modified_count
+    return updated
+
+
+async def backfill() -> int:
+    from . import db
+    from .models import DOCUMENT_MODELS
+    from .settings import get_settings
+
+    await db.connect(get_settings(), DOCUMENT_MODELS, sync_indexes=False)
+    for model in DOCUMENT_MODELS:
+        if "name_key" in model.model_fields:
+            print(f"{model.__name__}: {await backfill_name_keys(model)} documents updated")
+    db.close()
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m server.search", description="dei0 catalog search")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backfill", help="fill name_key in the documents that miss it")
+    parser.parse_args(argv)
+    return asyncio.run(backfill())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
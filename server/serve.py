@@ -0,0 +1,57 @@
+"""
+Production entry point: python -m server.serve
+
+Runs gunicorn with uvicorn workers. The app is imported once in the master
+(preload) and forked into one worker per CPU core (DEI0_WORKERS). Each worker
+connects to Mongo, initializes Beanie and opens its pool in the startup hook,
+before it accepts connections.
+
+Rolling restarts:
+ kill -HUP <master pid>    replaces the workers one by one with the already loaded code
+ kill -USR2 <master pid>   starts a new master with the new code, then kill -TERM the old one
+"""
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+
+from .metrics import mark_process_dead
+from .settings import Settings, get_settings
+
+
+def worker_count(settings: Settings) -> int:
+    return settings.workers if settings.workers > 0 else multiprocessing.cpu_count()
+
+
+class Server(BaseApplication):
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        super().__init__()
+
+    def load_config(self):
+        config = {
+            "bind": f"{self.settings.host}:{self.settings.port}",
+            "workers": worker_count(self.settings),
+            "worker_class": "uvicorn.workers.UvicornWorker",
+            "preload_app": True,
+            "graceful_timeout": self.settings.graceful_timeout,
+            "keepalive": self.settings.keepalive,
+            "max_requests": self.settings.max_requests,
+            "max_requests_jitter": self.settings.max_requests_jitter,
+            "proc_name": self.settings.app_name,
+            # multiprocess metrics: drop the live gauges of a worker that exited
+            "child_exit": lambda server, worker: mark_process_dead(worker.pid),
+        }
+        for key, value in config.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from .app import app
+        return app
+
+
+def main():
+    Server(get_settings()).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import os
+from functools import lru_cache
+from typing import Optional
+
+from pydantic import BaseModel
+
+ENV_PREFIX = "DEI0_"
+
+
+class Settings(BaseModel):
+    """
+    Server settings, every field can be set with the DEI0_<FIELD NAME> environment variable
+    (e.g. DEI0_MONGODB_URI, DEI0_MAX_POOL_SIZE).
+    """
+    mongodb_uri: str = "mongodb://localhost:27017/dei0"
+    mongodb_database: str = "dei0"
+    app_name: str = "dei0"
+
+    # connection pool
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    max_idle_time_ms: Optional[int] = None
+    wait_queue_timeout_ms: Optional[int] = None
+    connect_timeout_ms: int = 20000
+    server_selection_timeout_ms: int = 30000
+    socket_timeout_ms: Optional[int] = None
+    compressors: Optional[str] = None  # comma separated: zstd,snappy,zlib
+
+    # false to boot without checking/building indexes, run `python -m server.indexes sync` on deploy
+    sync_indexes: bool = True
+
+    # production launcher (python -m server.serve)
+    host: str = "0.0.0.0"
+    port: int = 8000
+    workers: int = 0  # 0: one per CPU core
+    graceful_timeout: int = 30
+    keepalive: int = 5
+    max_requests: int = 0  # recycle a worker after this many requests, 0 never
+    max_requests_jitter: int = 0
+
+    # seconds a worker may keep serving a cached user changed through another worker
+    user_cache_ttl: int = 30
+
+    # bcrypt runs on a thread pool of this size in every worker process, with this cost factor
+    password_hash_workers: int = 2
+    bcrypt_rounds: int = 12
+
+    # GET routes of the catalog routers (ingredients, recipes)
+    catalog_read_preference: str = "primary"
+    catalog_read_concern: Optional[str] = None
+
+    # admission control: per class of requests, how many run at once and how many may wait (503 beyond)
+    admission_control: bool = False
+    catalog_read_concurrency: int = 64
+    catalog_read_queue: int = 256
+    mealplan_write_concurrency: int = 16
+    mealplan_write_queue: int = 64
+    default_concurrency: int = 64
+    default_queue: int = 256
+    admission_queue_timeout_ms: int = 2000
+    retry_after: int = 1  # seconds, sent with the 503
+    # deadline of every request, its Mongo operations get the remaining time as maxTimeMS (0: none)
+    request_timeout_ms: int = 0
+
+    # /metrics, request and mongo command/pool metrics
+    metrics: bool = True
+
+    # list GETs send the documents as read from mongo, skipping model parsing and response validation
+    raw_reads: bool = False
+
+    # /meals/analytics reads the per (state, gender) rollups, refreshed with `python -m server.analytics refresh`
+    analytics_rollups: bool = False
+
+    # GET /meals/changes, one change stream per worker (needs a replica set)
+    change_feed: bool = False
+    change_feed_buffer: int = 1000  # recent events kept for reconnecting clients
+
+    # development/staging: explain every query shape once, /query-plans reports collection scans
+    query_plans: bool = False
+    query_plan_max_ratio: float = 10.0  # flag plans examining more documents than this per document returned
+    query_plan_min_docs_examined: int = 100
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        values = {}
+        for name in cls.model_fields:
+            value = os.environ.get(ENV_PREFIX + name.upper())
+            if value is not None and value != "":
+                values[name] = value
+        return cls(**values)
+
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    return Settings.from_env()
@@ -0,0 +1,89 @@
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Type, Union
+from uuid import uuid4
+
+from beanie import Document, PydanticObjectId, UpdateResponse
+from beanie.odm.utils.encoder import Encoder
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
+
+from .conditional import DocumentStamp, revision_condition, uses_revision
+
+# never written from a request body
+PROTECTED_FIELDS = ("_id", "id", "revision_id", "created_at", "updated_at")
+
+
+@lru_cache(maxsize=None)
+def field_adapter(model: Type[Document], name: str) -> TypeAdapter:
+    return TypeAdapter(model.model_fields[name].annotation)
+
+
+def validate_partial(model: Type[Document], data: Mapping[str, Any], readonly: Iterable[str] = ()) -> Dict[str, Any]:
+    """
+    Validate a partial payload field by field against the model.
+
+    Protected and readonly fields are dropped, unknown fields and invalid
+    values raise a 422 before anything is written.
+    """
+    skipped = set(PROTECTED_FIELDS) | set(readonly)
+    values, errors = {}, []
+    for name, value in data.items():
+        if name in skipped:
+            continue
+        if name not in model.model_fields:
+            errors.append({"loc": ("body", name), "msg": "unknown field", "type": "value_error.unknown_field"})
+            continue
+        try:
+            values[name] = field_adapter(model, name).validate_python(value)
+        except ValidationError as error:
+            errors.extend({**e, "loc": ("body", name, *e["loc"])} for e in error.errors())
+    if errors:
+        raise RequestValidationError(errors)
+    return values
+
+
+def replacement_fields(document: Document, readonly: Iterable[str] = ()) -> Dict[str, Any]:
+    """Fields of a full replace body, as validated python values (protected and readonly dropped)."""
+    skipped = set(PROTECTED_FIELDS) | set(readonly)
+    return {name: getattr(document, name) for name in document.model_fields if name not in skipped}
+
+
+def to_mongo(model: Type[Document], values: Dict[str, Any]) -> Dict[str, Any]:
+    """Encode validated values for a $set, refreshing updated_at and the revision when the model has them."""
+    fields = Encoder(to_db=True).encode(values)
+    if "updated_at" in model.model_fields:
+        fields["updated_at"] = datetime.utcnow()
+    if uses_revision(model):
+        fields["revision_id"] = uuid4()
+    return fields
+
+
+def literal_set(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """$set stage of an update pipeline, the values are written as they are and never read as expressions."""
+    return {"$set": {name: {"$literal": value} for name, value in fields.items()}}
+
+
+async def update_and_get(model: Type[Document], document_id: PydanticObjectId,
+                         update: Union[Dict[str, Any], List[Dict[str, Any]]],
+                         not_found_detail: str, if_match: Optional[str] = None,
+                         response_type: UpdateResponse = UpdateResponse.NEW_DOCUMENT) -> Document:
+    """
+    Apply the update and return the document after it (before it with
+    UpdateResponse.OLD_DOCUMENT), in one find_one_and_update.
+
+    With If-Match the update only applies to that revision, otherwise 412.
+    A full replace is a $set of every field, so readers never see a half
+    written document and created_at is kept. The update may also be a
+    pipeline, for fields computed from the stored document.
+    """
+    query = {"_id": document_id}
+    if if_match is not None:
+        query.update(await revision_condition(model, document_id, if_match))
+    document = await model.find_one(query).update(update, response_type=response_type)
+    if document is None:
+        if if_match is not None and await model.find_one({"_id": document_id}).project(DocumentStamp) is not None:
+            raise HTTPException(status_code=412, detail="If-Match does not match the current revision")
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    return document
@@ -1,24 +1,170 @@
-from typing import Optional
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
 
+import jwt
 from beanie import PydanticObjectId
 from fastapi import Depends, Request
-from fastapi_users import BaseUserManager, FastAPIUsers
+from fastapi_users import BaseUserManager, FastAPIUsers, exceptions, schemas
 from fastapi_users.authentication import (
     AuthenticationBackend,
     BearerTransport,
     JWTStrategy,
 )
 from fastapi_users.db import BeanieUserDatabase, ObjectIDIDMixin
+from fastapi.security import OAuth2PasswordRequestForm
+from fastapi_users.jwt import decode_jwt, generate_jwt
 
 from .models import User, get_user_db
+from .passwords import PasswordPool
+from .settings import get_settings
 
 SECRET = "EstaEsUnaAplicacionParaElControlDeLaObesidadEnLatinosDeEEUU"
+USER_CACHE_SIZE = 10000
+
+
+class UserCache:
+    """
+    Bounded LRU of verified token -> user, one per worker process.
+
+    An entry lives until the token exp (capped to max_ttl, DEI0_USER_CACHE_TTL)
+    and is dropped as soon as the user is updated or deleted in this process.
+    Other workers only see the change when their entry expires, so a
+    deactivated user or a new role may take up to max_ttl to apply everywhere.
+
+    Every invalidation bumps the generation: a user read from Mongo before it
+    is not cached, the read may predate the change.
+    """
+    def __init__(self, max_size: int = USER_CACHE_SIZE, max_ttl: float = 30):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self.generation = 0
+        self._entries: "OrderedDict[str, Tuple[User, float]]" = OrderedDict()
+        self._tokens_by_user: Dict[Any, Set[str]] = {}
+
+    def get(self, token: str) -> Optional[User]:
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        user, expires_at = entry
+        if expires_at <= time.time():
+            self._remove(token)
+            return None
+        self._entries.move_to_end(token)
+        return user
+
+    def put(self, token: str, user: User, expires_at: Optional[float], generation: int):
+        if generation != self.generation:
+            return
+        now = time.time()
+        expires_at = min(expires_at or now + self.max_ttl, now + self.max_ttl)
+        self._remove(token)
+        self._entries[token] = (user, expires_at)
+        self._tokens_by_user.setdefault(user.id, set()).add(token)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: Any):
+        self.generation += 1
+        for token in self._tokens_by_user.pop(PydanticObjectId(user_id), set()):
+            self._entries.pop(token, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+        self._tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        tokens = self._tokens_by_user.get(entry[0].id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[entry[0].id]
+
+
+user_cache = UserCache(max_ttl=get_settings().user_cache_ttl)
+password_pool = PasswordPool.from_settings(get_settings())
 
 
 class UserManager(ObjectIDIDMixin, BaseUserManager[User, PydanticObjectId]):
+    """
+    fastapi-users manager whose bcrypt calls run on password_pool.
+
+    create, authenticate, forgot/reset password and password updates follow
+    fastapi-users 12 step by step, only the hashing is awaited instead of
+    blocking the event loop.
+    """
     reset_password_token_secret = SECRET
     verification_token_secret = SECRET
 
+    def __init__(self, user_db: BeanieUserDatabase, pool: PasswordPool = password_pool):
+        super().__init__(user_db, password_helper=pool.helper)
+        self.pool = pool
+
+    async def create(self, user_create: schemas.UC, safe: bool = False, request: Optional[Request] = None) -> User:
+        await self.validate_password(user_create.password, user_create)
+        if await self.user_db.get_by_email(user_create.email) is not None:
+            raise exceptions.UserAlreadyExists()
+        user_dict = user_create.create_update_dict() if safe else user_create.create_update_dict_superuser()
+        user_dict["hashed_password"] = await self.pool.hash(user_dict.pop("password"))
+        created_user = await self.user_db.create(user_dict)
+        await self.on_after_register(created_user, request)
+        return created_user
+
+    async def authenticate(self, credentials: OAuth2PasswordRequestForm) -> Optional[User]:
+        try:
+            user = await self.get_by_email(credentials.username)
+        except exceptions.UserNotExists:
+            # hash anyway, an unknown email answers as slowly as a wrong password
+            await self.pool.hash(credentials.password)
+            return None
+        verified, updated_password_hash = await self.pool.verify_and_update(credentials.password, user.hashed_password)
+        if not verified:
+            return None
+        if updated_password_hash is not None:
+            await self.user_db.update(user, {"hashed_password": updated_password_hash})
+        return user
+
+    async def forgot_password(self, user: User, request: Optional[Request] = None) -> None:
+        if not user.is_active:
+            raise exceptions.UserInactive()
+        token_data = {
+            "sub": str(user.id),
+            "password_fgpt": await self.pool.hash(user.hashed_password),
+            "aud": self.reset_password_token_audience,
+        }
+        token = generate_jwt(token_data, self.reset_password_token_secret, self.reset_password_token_lifetime_seconds)
+        await self.on_after_forgot_password(user, token, request)
+
+    async def reset_password(self, token: str, password: str, request: Optional[Request] = None) -> User:
+        try:
+            data = decode_jwt(token, self.reset_password_token_secret, [self.reset_password_token_audience])
+            user_id, password_fingerprint = data["sub"], data["password_fgpt"]
+            parsed_id = self.parse_id(user_id)
+        except (jwt.PyJWTError, KeyError, exceptions.InvalidID):
+            raise exceptions.InvalidResetPasswordToken()
+        user = await self.get(parsed_id)
+        valid_password_fingerprint, _ = await self.pool.verify_and_update(user.hashed_password, password_fingerprint)
+        if not valid_password_fingerprint:
+            raise exceptions.InvalidResetPasswordToken()
+        if not user.is_active:
+            raise exceptions.UserInactive()
+        updated_user = await self._update(user, {"password": password})
+        await self.on_after_reset_password(user, request)
+        return updated_user
+
+    async def _update(self, user: User, update_dict: Dict[str, Any]) -> User:
+        # the base class writes hashed_password as any other field, the new password is hashed here
+        password = update_dict.get("password")
+        if password is not None:
+            await self.validate_password(password, user)
+            update_dict = {field: value for field, value in update_dict.items() if field != "password"}
+            update_dict["hashed_password"] = await self.pool.hash(password)
+        return await super()._update(user, update_dict)
+
     async def on_after_register(self, user: User, request: Request ):
         print(f"User {user.id} has registered.")
 
@@ -32,6 +178,20 @@ class UserManager(ObjectIDIDMixin, BaseUserManager[User, PydanticObjectId]):
     ):
         print(f"Verification requested for user {user.id}. Verification token: {token}")
 
+    async def on_after_update(
+        self, user: User, update_dict: Dict[str, Any], request: Optional[Request] = None
+    ):
+        user_cache.invalidate_user(user.id)
+
+    async def on_after_verify(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate_user(user.id)
+
+    async def on_after_reset_password(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate_user(user.id)
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate_user(user.id)
+
 
 async def get_user_manager(user_db: BeanieUserDatabase = Depends(get_user_db)):
     yield UserManager(user_db)
@@ -40,8 +200,35 @@ async def get_user_manager(user_db: BeanieUserDatabase = Depends(get_user_db)):
 bearer_transport = BearerTransport(tokenUrl="auth/jwt/login")
 
 
+class CachedJWTStrategy(JWTStrategy):
+    """JWTStrategy that reads the user from user_cache instead of Mongo while the token is valid."""
+
+    async def read_token(self, token: Optional[str], user_manager: BaseUserManager) -> Optional[User]:
+        if token is None:
+            return None
+        user = user_cache.get(token)
+        if user is not None:
+            return user
+
+        try:
+            data = decode_jwt(token, self.decode_key, self.token_audience, algorithms=[self.algorithm])
+            user_id = data.get("sub")
+            if user_id is None:
+                return None
+        except jwt.PyJWTError:
+            return None
+
+        generation = user_cache.generation
+        try:
+            user = await user_manager.get(user_manager.parse_id(user_id))
+        except (exceptions.UserNotExists, exceptions.InvalidID):
+            return None
+        user_cache.put(token, user, data.get("exp"), generation)
+        return user
+
+
 def get_jwt_strategy() -> JWTStrategy:
-    return JWTStrategy(secret=SECRET, lifetime_seconds=3600)
+    return CachedJWTStrategy(secret=SECRET, lifetime_seconds=3600)
 
 
 auth_backend = AuthenticationBackend(